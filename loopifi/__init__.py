@@ -1,24 +1,27 @@
 from datetime import datetime, timedelta
 from dateutil import rrule
-from flask import Flask, request, redirect, render_template, url_for, flash
+from flask import Flask, request, redirect, render_template, url_for, flash, abort
 from flask_migrate import Migrate
 from flask_rq2 import RQ
 from flask_sqlalchemy import SQLAlchemy
 from sentry_sdk.integrations.flask import FlaskIntegration
 
 from loopifi.downloader import download_video
-from loopifi.loops import make_loops
+from loopifi.loops import make_loops, check_lazy_loop, render_lazy_loop, expire_render_sources
 from loopifi.parrots import random_parrot
 from loopifi.logging_setup import get_logger
 
 import re
 import sentry_sdk
 import shutil
+import time
 import os
 
 
 logger = get_logger(__name__)
 
+EXPIRE_RENDERS_JOB_ID = "expire-renders"
+
 sentry_sdk.init(
     dsn="https://c9a949f71fee489795e1c655e08e2d7c@sentry.io/1314208",
     integrations=[FlaskIntegration()],
@@ -38,6 +41,9 @@ def create_app():
         MAX_CONTENT_LENGTH=16 * 1024 * 1024,
         RQ_REDIS_URL="redis://localhost:6379/0",
         UPLOAD_FOLDER=os.path.join(os.path.dirname(__file__), "static", "res"),
+        # How long a request for a loop that's being rendered waits before redirecting to itself, and how many times
+        RENDER_WAIT_SECONDS=2,
+        RENDER_WAIT_ATTEMPTS=15,
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
         # http://www.daniloaz.com/en/how-to-create-a-user-in-mysql-mariadb-and-grant-permissions-on-a-specific-database/
         # for creating the user with correct username/password
@@ -97,7 +103,7 @@ def create_app():
         videos = db.relationship("Video")
 
     @rq.job(timeout=500)
-    def loopify(_id, path, url=None, sound=True):
+    def loopify(_id, path, url=None, sound=True, stabilize=False):
         # define our callback for updating the job progress
         def update_record(status=None, progress=None):
             if status is not None:
@@ -118,7 +124,13 @@ def create_app():
                 db.session.commit()
 
                 # download the youtube video
-                download_video(url, path, record.start_seconds, record.end_seconds)
+                download_video(
+                    url,
+                    path,
+                    record.start_seconds,
+                    record.end_seconds,
+                    cache=rq.connection,
+                )
 
                 # correct the seconds offsets for a ~30 second video
                 # because the downloaded video already starts at record.start_seconds
@@ -134,6 +146,7 @@ def create_app():
                 start_time=record.start_seconds,
                 end_time=record.end_seconds,
                 sound_enabled=sound,
+                stabilize=stabilize,
             )
 
             for r in result:
@@ -156,6 +169,22 @@ def create_app():
             record.finished_at = datetime.utcnow()
             db.session.commit()
 
+        # Jobs keep their source video to render loops from until it expires, which one job at a time looks after
+        job = rq.get_queue().fetch_job(EXPIRE_RENDERS_JOB_ID)
+
+        if job is None or job.is_finished or job.is_failed:
+            expire_renders.queue(job_id=EXPIRE_RENDERS_JOB_ID)
+
+    @rq.job(timeout=300)
+    def render_loop(_id, file_name):
+        folder = os.path.join(app.config["UPLOAD_FOLDER"], "{}".format(_id), "Loops")
+
+        render_lazy_loop(folder, file_name)
+
+    @rq.job(timeout=3600)
+    def expire_renders():
+        expire_render_sources()
+
     @app.route("/", methods=["GET"])
     def index():
         return render_template("index.html")
@@ -300,6 +329,54 @@ def create_app():
 
         return render_template("results.html", record=record, maxScore=maxScore)
 
+    @app.route("/loops/<_id>/render/<file_name>", methods=["GET"])
+    def render(_id, file_name):
+        # gifs & mp4s are only rendered by a worker the first time someone asks for them
+        record = Record.query.get_or_404(_id)
+
+        if not record.done or record.failed:
+            abort(404)
+
+        folder = os.path.join(app.config["UPLOAD_FOLDER"], "{}".format(record.id), "Loops")
+        loop_path = os.path.join(folder, file_name)
+
+        # Only loops that aren't there yet need render info, jobs that render all their loops right away have none
+        if not os.path.isfile(loop_path):
+            try:
+                check_lazy_loop(folder, file_name)
+            except (ValueError, FileNotFoundError):
+                abort(404)
+
+            # One render job per file, however many requests ask for it
+            job_id = "render-{}-{}".format(record.id, file_name)
+            job = rq.get_queue().fetch_job(job_id)
+
+            if job is not None and job.is_failed:
+                abort(500)
+
+            if job is None or job.is_finished:
+                render_loop.queue(record.id, file_name, job_id=job_id)
+
+            deadline = time.time() + app.config["RENDER_WAIT_SECONDS"]
+
+            while not os.path.exists(loop_path) and time.time() < deadline:
+                time.sleep(0.25)
+
+        if not os.path.exists(loop_path):
+            attempt = request.args.get("attempt", 0, type=int)
+
+            if attempt >= app.config["RENDER_WAIT_ATTEMPTS"]:
+                return "Still rendering, try again in a bit", 503, {"Retry-After": "5"}
+
+            # Browsers follow the redirect, so <img> & <video> tags keep waiting for it without holding up a worker
+            return redirect(
+                url_for("render", _id=record.id, file_name=file_name, attempt=attempt + 1)
+            )
+
+        return redirect(
+            url_for("static", filename="res/{}/Loops/{}".format(record.id, file_name))
+        )
+
     @app.route("/stats")
     def stats():
         # generate data for the charts
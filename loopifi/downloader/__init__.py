@@ -1,6 +1,10 @@
+import os
 import re
 import json
+import time
+import threading
 import subprocess
+from urllib.parse import urlparse, parse_qs
 
 from loopifi.logging_setup import get_logger
 from youtube_dl import YoutubeDL
@@ -9,11 +13,47 @@ logger = get_logger(__name__)
 
 VIDEO_HEIGHT = 360
 
+# Download URLs picked by `filter_urls` are cached per video ID, so popular videos skip youtube-dl. They're signed to
+# expire after a few hours, so entries expire well before that, and never later than METADATA_CACHE_EXPIRY_MARGIN
+# seconds before the URL's own `expire` time
+METADATA_CACHE_TTL = int(os.environ.get("METADATA_CACHE_TTL", 60 * 60))
+METADATA_CACHE_EXPIRY_MARGIN = 10 * 60
+METADATA_CACHE_PREFIX = "loopifi:download_url:"
+
 
 class InvalidUrlException(Exception):
     """Called if valid download url cannot be found"""
 
 
+class LocalMetadataCache(object):
+    """In-process stand-in for the Redis connection used as the metadata cache, with the same get/setex/delete calls"""
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value, expires_at = self.entries.get(key, (None, None))
+
+            if expires_at is not None and expires_at <= time.time():
+                del self.entries[key]
+                return None
+
+            return value
+
+    def setex(self, key, seconds, value):
+        with self.lock:
+            self.entries[key] = (value, time.time() + seconds)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+local_metadata_cache = LocalMetadataCache()
+
+
 def youtube_url_validation(url):
     """Check if the link is a valid youtube URL. Source: https://stackoverflow.com/a/19161373/11692859"""
     youtube_regex = (
@@ -82,12 +122,8 @@ def filter_urls(video_formats):
     return real_url
 
 
-def download_video(url, path, start_seconds, end_seconds):
-    """Downloads a video from youtube"""
-    logger.info(f"Attempting to downloading: {url}")
-
-    if not youtube_url_validation(url):
-        raise InvalidUrlException("Must be a youtube URL!")
+def extract_download_url(url):
+    """Runs youtube-dl on the URL, and picks the URL to download the video from"""
 
     # Prevents weird certificate error on MacOS
     options_youtube_dl = {"nocheckcertificate": True}
@@ -105,7 +141,49 @@ def download_video(url, path, start_seconds, end_seconds):
         raise InvalidUrlException("URL rejected by youtube-dl!")
 
     # Filter the urls to get the most optimal download link
-    real_url = filter_urls(info_dictionary["formats"])
+    return filter_urls(info_dictionary["formats"])
+
+
+def get_cache_ttl(real_url):
+    """How long the download URL can be cached for, which can be no time at all if it's about to expire"""
+    ttl = METADATA_CACHE_TTL
+
+    # Signed URLs say when they expire in their `expire` parameter
+    expire = parse_qs(urlparse(real_url).query).get("expire")
+
+    if expire and expire[0].isdigit():
+        ttl = min(ttl, int(int(expire[0]) - time.time() - METADATA_CACHE_EXPIRY_MARGIN))
+
+    return ttl
+
+
+def get_download_url(video_id, url, cache, refresh=False):
+    """Gets the URL to download the video from out of the cache, or from youtube-dl if it's not cached or `refresh`"""
+    cache_key = METADATA_CACHE_PREFIX + video_id
+
+    if not refresh:
+        real_url = cache.get(cache_key)
+
+        if real_url is not None:
+            logger.info(f"Using cached download URL for video {video_id}")
+
+            # Redis hands back bytes
+            return real_url.decode("UTF-8") if isinstance(real_url, bytes) else real_url
+
+    real_url = extract_download_url(url)
+
+    ttl = get_cache_ttl(real_url)
+
+    if ttl > 0:
+        cache.setex(cache_key, ttl, real_url)
+    else:
+        cache.delete(cache_key)
+
+    return real_url
+
+
+def run_ffmpeg_download(real_url, path, start_seconds, end_seconds):
+    """Downloads the part of the video between the start & end seconds with ffmpeg, returning its exit code & output"""
 
     # format start and end seconds into timestamps
     start_time_formatted = f"{int(start_seconds / 3600)}:{int((start_seconds % 3600) / 60)}:{start_seconds % 60}.00"
@@ -141,6 +219,8 @@ def download_video(url, path, start_seconds, end_seconds):
     )
 
     # Wait until the process finishes before returning
+    output = ""
+
     while running_process.poll() is None:
         output, error = running_process.communicate()
         if running_process.returncode != 0:
@@ -149,6 +229,43 @@ def download_video(url, path, start_seconds, end_seconds):
             )
             logger.error(f"Received error: {error}", exc_info=True)
 
+    return running_process.returncode, output
+
+
+def download_video(url, path, start_seconds, end_seconds, cache=None):
+    """Downloads a video from youtube
+
+    The download URL is cached per video ID in `cache`, e.g. the Redis connection RQ uses, or a process-local cache if
+    none is given. A cached URL that's been rejected with a 403 is refreshed through youtube-dl once.
+    """
+    logger.info(f"Attempting to downloading: {url}")
+
+    youtube_url_match = youtube_url_validation(url)
+
+    if not youtube_url_match:
+        raise InvalidUrlException("Must be a youtube URL!")
+
+    if cache is None:
+        cache = local_metadata_cache
+
+    video_id = youtube_url_match.group(6)
+
+    real_url = get_download_url(video_id, url, cache)
+
+    return_code, output = run_ffmpeg_download(real_url, path, start_seconds, end_seconds)
+
+    # The signed URL expired or got revoked before its cache entry did
+    if return_code != 0 and "403" in (output or ""):
+        logger.info(f"Download URL of video {video_id} was rejected, refreshing it")
+
+        real_url = get_download_url(video_id, url, cache, refresh=True)
+        return_code, output = run_ffmpeg_download(real_url, path, start_seconds, end_seconds)
+
+        # Don't hand the refreshed URL to the next job either, and fail here rather than on a missing or partial video
+        if return_code != 0:
+            cache.delete(METADATA_CACHE_PREFIX + video_id)
+            raise InvalidUrlException("Video could not be downloaded!")
+
     logger.info(f"Successfully downloaded file to: {path}")
 
 
@@ -1,13 +1,31 @@
 import os
 import sys
+import heapq
+import hashlib
+import re
+import queue
 import shutil
+import tempfile
+import itertools
+import json
+import time
+import fcntl
+import multiprocessing
+import threading
 import subprocess
-from collections import namedtuple
+from collections import deque, namedtuple
+from fractions import Fraction
+from functools import lru_cache
+from ctypes import c_float, c_int64, c_uint64
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing.sharedctypes import RawArray
 
 # noinspection PyUnresolvedReferences, PyPackageRequirements
 import context
 import cv2
-import imagehash
+import numpy as np
+import scipy.fftpack
+from numpy.lib.stride_tricks import as_strided
 from PIL import Image
 from ntpath import basename
 from loopifi.logging_setup import get_logger
@@ -29,6 +47,82 @@ MAX_HASH_DIFFERENCE = (HASH_SIZE ** 2) * 4
 MIN_MID_FRAME_SIMILARITY = 4
 SIMILARITY_THRESHOLD = MAX_HASH_DIFFERENCE * 0.75
 SEARCH_STEP_SIZE = 5  # Granularity/specificity of the loop search
+COARSE_SEARCH_STEP_SIZE = 15  # Coarser step used for long intervals, whose loops then get refined
+COARSE_SEARCH_MIN_FRAMES = 3600  # Intervals with at least this many frames are searched at the coarse step
+HASH_WORDS = (HASH_SIZE ** 2) // 64  # Number of uint64 words in a packed hash
+
+# Hash cascade: pairs of frames are first compared on the size x size lowest frequency corner of their hashes, and
+# are rejected without comparing the full hash if more than the given fraction of those bits differ
+HASH_CASCADE = True
+HASH_CASCADE_LEVELS = ((8, 0.4), (16, 0.35))
+
+# How `find_best_matches` searches: "band" compares every start frame with all of its candidates, "pivot" orders the
+# candidates by a triangle inequality lower bound on their distance, and skips those that can't beat the best so far
+SEARCH_BACKEND = "band"
+SEARCH_PIVOTS = 16  # Number of pivot frames the "pivot" backend bounds distances with
+
+# Loops never span a hard cut, so only frames within the same shot are compared. A cut is where more than
+# SCENE_CUT_THRESHOLD of the bits of the SCENE_CUT_HASH_SIZE x SCENE_CUT_HASH_SIZE lowest frequency corner of the hash
+# change from one hashed frame to the next. The high frequency bits flip too much within a shot to go by. So that fast
+# motion doesn't count as a string of cuts, the change also has to be SCENE_CUT_CONTRAST times the median change of
+# the SCENE_CUT_WINDOW hashed frames on either side
+SCENE_CUTS = True
+SCENE_CUT_HASH_SIZE = 8
+SCENE_CUT_THRESHOLD = 0.35
+SCENE_CUT_CONTRAST = 2
+SCENE_CUT_WINDOW = 4
+
+# Motion energy of a hashed frame is the mean absolute difference (in gray levels) between the MOTION_THUMBNAIL_SIZE x
+# MOTION_THUMBNAIL_SIZE block averages of it and of the hashed frame before it. Start frames followed by at least
+# STATIC_RUN_FRAMES frames with less motion than STATIC_MOTION_THRESHOLD are skipped by the search
+MOTION_PREFILTER = True
+MOTION_THUMBNAIL_SIZE = 16
+STATIC_MOTION_THRESHOLD = 1.0
+STATIC_RUN_FRAMES = 30
+HASH_INPUT_SIZE = HASH_SIZE * 4  # Side of the grayscale image phash runs the DCT on (imagehash's highfreq_factor)
+HASH_BATCH_SIZE = 64  # How many sampled frames are hashed together
+
+# Where hash-ready frames come from: "ffmpeg" decodes, samples, grays & downscales them in a single ffmpeg process.
+# "opencv" decodes with cv2 & resizes with PIL, which gives hashes bit-identical to `imagehash.phash`
+FRAME_READER = "ffmpeg"
+
+# Decoding runs on its own thread while a pool of workers hashes the decoded batches. What the pipeline of a job holds
+# in memory is capped at HASH_MEMORY_BUDGET bytes: every decoded batch it buffers, and the float64 DCT temporaries
+# `phash_batch` allocates for the batch each worker is hashing, about 11 times the batch itself. The number of workers
+# & buffered batches is sized from the budget, rather than from the cores, which in a container are the host's. At
+# least one worker and one batch more than the workers always run, however small the budget
+HASH_MEMORY_BUDGET = int(os.environ.get("HASH_MEMORY_BUDGET", 256 * 1024 ** 2))
+HASH_BATCH_BYTES = HASH_BATCH_SIZE * HASH_INPUT_SIZE ** 2
+HASH_WORKER_BYTES = HASH_BATCH_BYTES * 11
+HASH_WORKERS = max(
+    min(
+        int(os.environ.get("HASH_WORKERS", os.cpu_count() or 1)),
+        (HASH_MEMORY_BUDGET - HASH_BATCH_BYTES) // (HASH_WORKER_BYTES + HASH_BATCH_BYTES),
+    ),
+    1,
+)
+HASH_PIPELINE_BATCHES = max(
+    min(HASH_WORKERS * 2, (HASH_MEMORY_BUDGET - HASH_WORKERS * HASH_WORKER_BYTES) // HASH_BATCH_BYTES),
+    HASH_WORKERS + 1,
+)
+
+# Search for loops while the video is still being hashed, instead of after all hashes are in
+STREAMING_SEARCH = True
+SEARCH_CHUNK_SIZE = 256  # How many start frames the streaming search finalizes at a time
+
+# Processes `search_for_loops` splits the start frames between, 1 searches on the calling process. The streaming
+# search hands its chunks to that many processes too, once there's more than a chunk for each of them
+SEARCH_WORKERS = int(os.environ.get("SEARCH_WORKERS", os.cpu_count() or 1))
+SEARCH_WORKER_CHUNK_SIZE = 1024  # How many start frames a search worker takes at a time
+
+# Hashes are kept on disk per video content, so re-submitting a video only hashes the frames that weren't hashed yet
+HASH_CACHE = True
+HASH_CACHE_FOLDER = os.environ.get(
+    "HASH_CACHE_FOLDER", os.path.join(tempfile.gettempdir(), "loopifi_hash_cache")
+)
+HASH_CACHE_MAX_BYTES = int(os.environ.get("HASH_CACHE_MAX_BYTES", 1024 ** 3))
+CACHE_ENTRY_LOCK_NAME = ".lock"  # Held exclusively to create, load or evict an entry
+CACHE_ENTRY_IN_USE_NAME = ".in_use"  # Held shared by every job using an entry
 
 # Webm output related constants
 LOOP_WIDTH = 500  # The width in pixels of an encoded webm
@@ -36,6 +130,56 @@ NUMBER_WEBMS_TO_MAKE = 5  # How many webms we would like to make in total
 MINIMUM_LOOP_FRAMES = 15  # The minimum number of frames in a webm
 MAXIMUM_LOOP_FRAMES = 300  # The maximum number of frames in a webm
 
+# How loops get encoded: "single" decodes each loop once & writes the webm, mp4 & gif from one ffmpeg filter graph,
+# "separate" runs one ffmpeg process per output (and one more for the gif palette)
+ENCODE_MODE = "single"
+
+# Loops are encoded concurrently, as many at a time as fit in ENCODE_CPU_BUDGET cores with ENCODE_THREADS encoder
+# threads each
+ENCODE_CPU_BUDGET = int(os.environ.get("ENCODE_CPU_BUDGET", os.cpu_count() or 1))
+ENCODE_THREADS = 2
+
+# With LAZY_RENDERING, the LAZY_FORMATS of a loop are only rendered the first time they're requested, see
+# `render_lazy_loop`. The webm is always encoded right away. Stabilized jobs render every format right away instead,
+# rather than keep their stabilized video around. The source video is moved out of the job folder, which is served
+# publicly, into a folder of RENDER_SOURCE_FOLDER named after the job folder, along with the RENDER_INFO_FILE that
+# tells how to render the loops. It stays there for RENDER_SOURCE_TTL seconds, or less when the render sources of all
+# jobs take more than RENDER_SOURCE_MAX_BYTES, see `expire_render_sources`. Loops that weren't asked for by then are
+# rendered before it goes
+LAZY_RENDERING = True
+LAZY_FORMATS = ("gif", "mp4")
+RENDER_INFO_FILE = "render_info.json"
+RENDER_SOURCE_FOLDER = os.environ.get(
+    "RENDER_SOURCE_FOLDER", os.path.join(tempfile.gettempdir(), "loopifi_render_sources")
+)
+RENDER_SOURCE_TTL = int(os.environ.get("RENDER_SOURCE_TTL", 24 * 60 * 60))
+RENDER_SOURCE_MAX_BYTES = int(os.environ.get("RENDER_SOURCE_MAX_BYTES", 5 * 1024 ** 3))
+
+# With MEZZANINE, loops that get decoded more than once (one encode per format in the "separate" ENCODE_MODE) have
+# their frames transcoded once into an all-intra video at LOOP_WIDTH, and are encoded from that. Every frame of it is a
+# keyframe, so seeking to the loop is exact, and doesn't decode from the previous keyframe of the source for every
+# format. Each mezzanine only covers its own loop, and is deleted with the frames folder once the job is done
+MEZZANINE = True
+MEZZANINE_NAME = "mezzanine_{}.mkv"
+MEZZANINE_CRF = 12
+
+# Stabilization only looks at the searched window, scaled down to LOOP_WIDTH. Its transform vectors are cached in
+# HASH_CACHE_FOLDER per source video & window, and the stabilized window is written once as an all-intra video that's
+# both searched & encoded from
+STABILIZE_THREADS = int(os.environ.get("STABILIZE_THREADS", os.cpu_count() or 1))
+STABILIZE_DETECT_OPTIONS = "stepsize=6:shakiness=4:accuracy=5"
+STABLE_VIDEO_NAME = "stable.mkv"
+
+# With ANALYSIS_PROXY, hashing, scene cut & motion analysis read a small copy of the searched window, already scaled to
+# HASH_INPUT_SIZE, instead of decoding the source at full resolution. Loops are still encoded from the source. With
+# HASH_CACHE, proxies are kept in the hash cache entry of the source video, and reused for any window they cover
+ANALYSIS_PROXY = True
+ANALYSIS_PROXY_CRF = 12
+
+# Loops overlapping a better loop by more than this (intersection over union of their frames) count as the same loop
+LOOP_OVERLAP_THRESHOLD = 0.5
+CANDIDATE_POOL_SIZE = NUMBER_WEBMS_TO_MAKE * 50  # How many of the best loops are kept to pick distinct ones from
+
 # Enable to prevent temporary files from being deleted
 # Use from env-var like `DEBUG_MODE=1 python loops.py ...` or `DEBUG_MODE=1 flask rq worker`
 DEBUG_MODE = os.environ.get("DEBUG_MODE", False)
@@ -44,6 +188,20 @@ DEBUG_MODE = os.environ.get("DEBUG_MODE", False)
 # Class Definitions
 ##############################################################################################################
 
+# What `probe` finds out about a video. `frame_rate` is a Fraction
+MediaInfo = namedtuple(
+    "MediaInfo",
+    [
+        "duration",
+        "frame_rate",
+        "variable_frame_rate",
+        "frame_count",
+        "codec_name",
+        "width",
+        "height",
+    ],
+)
+
 LoopRecord = namedtuple(
     "webm",
     [
@@ -61,17 +219,294 @@ LoopRecord = namedtuple(
 
 
 class FrameHashDatabase(object):
-    def __init__(self, existing_hashes, path_of_source_video):
-        self.db = existing_hashes
+    """Packed hashes & motion energy of every `step_size`th frame, starting at `first_frame`
+
+    The hashes live in one contiguous (frames x HASH_WORDS) uint64 matrix, 512 bytes per frame, so finding the hash
+    of a frame is index arithmetic rather than a lookup
+    """
+
+    def __init__(self, hashes, first_frame, step_size, path_of_source_video=None, motion=None):
+        self.hashes = hashes
+        self.motion = motion
+        self.first_frame = first_frame
+        self.step_size = step_size
         self.path_of_source_video = path_of_source_video
 
+    @classmethod
+    def from_batches(cls, hash_batches, step_size, path_of_source_video=None):
+        """Builds the database from (frame_numbers, packed hashes, motion) batches, like `iter_frame_hashes` yields"""
+        frame_numbers = []
+        packed_hashes = []
+        motion = []
+
+        for batch_frame_numbers, hashes, batch_motion in hash_batches:
+            frame_numbers.extend(batch_frame_numbers)
+            packed_hashes.append(hashes)
+            motion.append(batch_motion)
+
+        if not packed_hashes:
+            return cls(
+                np.empty((0, HASH_WORDS), dtype=np.uint64),
+                0,
+                step_size,
+                path_of_source_video,
+                np.empty(0, dtype=np.float32),
+            )
+
+        hash_db = cls(
+            np.concatenate(packed_hashes),
+            frame_numbers[0],
+            step_size,
+            path_of_source_video,
+            np.concatenate(motion),
+        )
+
+        if not np.array_equal(hash_db.frame_numbers, frame_numbers):
+            raise ValueError(f"Hashed frames aren't every {step_size}th frame from {frame_numbers[0]} on")
+
+        return hash_db
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @property
+    def frame_numbers(self):
+        return self.first_frame + np.arange(len(self.hashes), dtype=np.int64) * self.step_size
+
+    def index(self, frame_number):
+        """Index of the first hashed frame at or after `frame_number`, clamped to the hashed frames"""
+        if not len(self.hashes):
+            raise IndexError("No frames were hashed")
+
+        index = -((self.first_frame - frame_number) // self.step_size)
+
+        return min(max(index, 0), len(self.hashes) - 1)
+
     def get(self, frame_number):
+        return self.hashes[self.index(frame_number)]
+
+
+class SampledFrameReader(object):
+    """Iterates over every `step_size`th frame of a video as (frame_number, frame)
+
+    Frames in between are only grabbed, so they skip the color conversion & copy into a numpy array that `read` does.
+    Only frames in [start_frame, end_frame) are visited, and frame numbers always count from the start of the video.
+    """
+
+    def __init__(self, video_path, step_size=SEARCH_STEP_SIZE, start_frame=0, end_frame=None):
+        self.video_capture = cv2.VideoCapture(video_path)
+        self.step_size = step_size
+        self.number_of_frames = probe(video_path).frame_count
+
+        # Sampled frames are the multiples of `step_size`, wherever the interval starts
+        self.start_frame = -(-start_frame // step_size) * step_size
+        self.end_frame = end_frame if end_frame is not None else self.number_of_frames
+
+    def __iter__(self):
+        current_frame = self.start_frame
+
+        if current_frame > 0:
+            self.video_capture.set(cv2.CAP_PROP_POS_FRAMES, current_frame)
+
+        try:
+            while self.video_capture.isOpened() and current_frame < self.end_frame:
+
+                if current_frame % self.step_size == 0:
+                    ret, frame = self.video_capture.read()
+
+                    if not ret:
+                        break
+
+                    yield current_frame, frame
+
+                elif not self.video_capture.grab():
+                    break
+
+                current_frame += 1
+        finally:
+            self.video_capture.release()
+
+
+class FrameBufferPool(object):
+    """A fixed set of preallocated frame batch buffers, shared by the decoder and the hashing workers
+
+    `acquire` blocks until a buffer has been released, which is what caps memory use of the hashing pipeline
+    """
+
+    class Closed(Exception):
+        """Thrown by `acquire` once the pool has been closed"""
+
+    def __init__(self, number_of_buffers, batch_size=HASH_BATCH_SIZE):
+        self.free_buffers = queue.Queue()
+        self.closed = False
+
+        for _ in range(number_of_buffers):
+            self.free_buffers.put(
+                np.empty((batch_size, HASH_INPUT_SIZE, HASH_INPUT_SIZE), dtype=np.uint8)
+            )
+
+    def acquire(self):
+        while not self.closed:
+            try:
+                return self.free_buffers.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+        raise FrameBufferPool.Closed()
+
+    def release(self, frames):
+        self.free_buffers.put(frames)
+
+    def close(self):
+        self.closed = True
+
+
+class FFmpegFrameReader(object):
+    """Reads every `step_size`th frame in [start_frame, end_frame) of a video, ready to be hashed
+
+    A single ffmpeg process seeks, selects the sampled frames, converts them to grayscale and downscales them to
+    HASH_INPUT_SIZE inside its filter graph. The raw frames are read from its stdout straight into buffers acquired
+    from `buffer_pool`. Iterating yields (frame_numbers, frames) batches, where the first len(frame_numbers) frames of
+    the buffer are filled. The consumer releases the buffer back to the pool once it's done with it.
+    """
+
+    def __init__(
+        self,
+        video_path,
+        frame_rate,
+        buffer_pool,
+        step_size=SEARCH_STEP_SIZE,
+        start_frame=0,
+        end_frame=None,
+    ):
+        self.video_path = video_path
+        self.frame_rate = frame_rate
+        self.step_size = step_size
+
+        # Sampled frames are the multiples of `step_size`, wherever the interval starts
+        self.start_frame = -(-start_frame // step_size) * step_size
+        self.end_frame = end_frame
+        self.buffer_pool = buffer_pool
+
+    def build_command(self):
+        # Seek half a frame early, so that rounding can't make ffmpeg drop the first frame we want
+        seek_time = max(self.start_frame - 0.5, 0) / self.frame_rate
+
+        command = [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-ss",
+            str(seek_time),
+            "-i",
+            self.video_path,
+            "-vf",
+            f"select=not(mod(n\\,{self.step_size})),format=gray,"
+            f"scale={HASH_INPUT_SIZE}:{HASH_INPUT_SIZE}:flags=lanczos",
+            "-vsync",
+            "0",
+        ]
+
+        if self.end_frame is not None:
+            number_of_samples = -(-(self.end_frame - self.start_frame) // self.step_size)
+            command.extend(["-frames:v", str(max(number_of_samples, 0))])
 
-        while frame_number not in self.db:
-            # check if the next frame over exists
-            frame_number += 1
+        command.extend(["-an", "-f", "rawvideo", "-pix_fmt", "gray", "-"])
 
-        return self.db[frame_number]
+        return command
+
+    def read_frame(self, stream, frame):
+        """Fills `frame` with the next raw frame from `stream`, returns False once the stream runs out"""
+        frame_bytes = memoryview(frame.reshape(-1))
+        bytes_read = 0
+
+        while bytes_read < len(frame_bytes):
+            chunk_size = stream.readinto(frame_bytes[bytes_read:])
+
+            if not chunk_size:
+                return False
+
+            bytes_read += chunk_size
+
+        return True
+
+    def __iter__(self):
+        if self.end_frame is not None and self.end_frame <= self.start_frame:
+            return
+
+        process = subprocess.Popen(self.build_command(), stdout=subprocess.PIPE)
+        frames = None
+
+        try:
+            current_frame = self.start_frame
+            frame_numbers = []
+            frames = self.buffer_pool.acquire()
+
+            while self.read_frame(process.stdout, frames[len(frame_numbers)]):
+                frame_numbers.append(current_frame)
+                current_frame += self.step_size
+
+                if len(frame_numbers) == len(frames):
+                    full_frames, frames = frames, None
+                    yield frame_numbers, full_frames
+
+                    frame_numbers = []
+                    frames = self.buffer_pool.acquire()
+
+            if frame_numbers:
+                full_frames, frames = frames, None
+                yield frame_numbers, full_frames
+        finally:
+            # Hand back a buffer we never got to yield
+            if frames is not None:
+                self.buffer_pool.release(frames)
+
+            process.stdout.close()
+            process.kill()
+            process.wait()
+
+
+class GrayFrameBatch(object):
+    """Batch of sampled frames, converted to grayscale and resized the way `imagehash.phash` does it
+
+    Frames are written into a buffer acquired from `buffer_pool`, which the consumer of `flush` releases
+    """
+
+    def __init__(self, buffer_pool):
+        self.buffer_pool = buffer_pool
+        self.frames = None
+        self.frame_numbers = []
+
+    def __len__(self):
+        return len(self.frame_numbers)
+
+    def is_full(self):
+        return self.frames is not None and len(self.frame_numbers) == len(self.frames)
+
+    def add(self, frame_number, frame):
+        if self.frames is None:
+            self.frames = self.buffer_pool.acquire()
+
+        cv2_image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        pillow_image = Image.fromarray(cv2_image).convert("L")
+        pillow_image = pillow_image.resize(
+            (HASH_INPUT_SIZE, HASH_INPUT_SIZE), Image.ANTIALIAS
+        )
+
+        self.frames[len(self.frame_numbers)] = np.asarray(pillow_image)
+        self.frame_numbers.append(frame_number)
+
+    def flush(self):
+        """Hands over the buffered frames, the next `add` starts a new buffer
+
+        :return: frame_numbers, buffer whose first len(frame_numbers) frames are filled
+        """
+        frame_numbers, frames = self.frame_numbers, self.frames
+
+        self.frame_numbers = []
+        self.frames = None
+
+        return frame_numbers, frames
 
 
 class CandidateLoop(object):
@@ -85,15 +520,317 @@ class CandidateLoop(object):
         self.start_time = self.start_frame_number / frame_rate
         self.duration = (self.end_frame_number - self.start_frame_number) / frame_rate
 
+        # The video this loop gets encoded from, if not the one every loop is encoded from, e.g. its mezzanine
+        self.source_path = None
+        # Where the video the loop gets encoded from starts in the source video
+        self.source_start_time = 0.0
+
         self.gif_palette_command = None
         self.gif_encode_command = None
         self.webm_encode_command = None
         self.mp4_encode_command = None
+        self.combined_encode_command = None
 
         self.gif_name = None
         self.webm_name = None
         self.mp4_name = None
 
+    @property
+    def seek_time(self):
+        """Where the loop starts in the video it gets encoded from"""
+        return self.start_time - self.source_start_time
+
+    def encode_commands(self):
+        """The ffmpeg commands that encode this loop, in the order they have to run"""
+        if self.combined_encode_command is not None:
+            return [self.combined_encode_command]
+
+        commands = [
+            self.gif_palette_command,
+            self.gif_encode_command,
+            self.webm_encode_command,
+            self.mp4_encode_command,
+        ]
+
+        # Formats that are rendered lazily have no commands
+        return [command for command in commands if command is not None]
+
+
+class CandidateSelector(object):
+    """Picks the best distinct loops out of a stream of candidates
+
+    Only the `pool_size` best candidates are kept, in a bounded heap. `select` then runs temporal non-maximum
+    suppression over them: going from best to worst, a loop is skipped if it overlaps an already selected one by more
+    than LOOP_OVERLAP_THRESHOLD, so the same loop shifted by a few frames doesn't get encoded twice.
+    """
+
+    def __init__(self, count=NUMBER_WEBMS_TO_MAKE, pool_size=CANDIDATE_POOL_SIZE):
+        self.count = count
+        self.pool_size = pool_size
+
+        # Entries are (-score, -arrival, candidate), so the root of the heap is the worst loop kept. Equal scores rank
+        # by arrival, like the stable sort in `search_for_loops`
+        self.heap = []
+        self.arrivals = itertools.count()
+
+    def push(self, candidate):
+        entry = (-candidate.score, -next(self.arrivals), candidate)
+
+        if len(self.heap) < self.pool_size:
+            heapq.heappush(self.heap, entry)
+        elif entry[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, entry)
+
+    def select(self):
+        best_first = [entry[2] for entry in sorted(self.heap, key=lambda x: x[:2], reverse=True)]
+        selected = []
+
+        for candidate in best_first:
+            if len(selected) == self.count:
+                break
+
+            if all(
+                loop_overlap(candidate, other) <= LOOP_OVERLAP_THRESHOLD
+                for other in selected
+            ):
+                selected.append(candidate)
+
+        return selected
+
+
+class IncrementalLoopSearch(object):
+    """Loop search that consumes hashes as they are produced, see `hash_frames`
+
+    A start frame only needs the hashes up to MAXIMUM_LOOP_FRAMES after it, so its best candidate is final as soon as
+    those are in. Only that sliding window of packed hashes is kept around, plus the SCENE_CUT_WINDOW frames on either
+    side of it that scene cuts are judged by. Start frames are finalized `chunk_size` at a time with
+    `find_best_matches`, which gives the same loops as `search_for_loops`. With more than one of `workers`, chunks are
+    searched on a pool of that many processes, while the hashes of the next ones keep coming in.
+
+    Loops are exposed as soon as their chunk has been searched, through `best_so_far` and the `on_loop_found`
+    callback. Only the best ones are kept, see `CandidateSelector`. `close` stops the search workers of a search that
+    isn't going to be finished
+    """
+
+    def __init__(
+        self,
+        frame_rate,
+        on_loop_found=None,
+        chunk_size=SEARCH_CHUNK_SIZE,
+        step_size=SEARCH_STEP_SIZE,
+        workers=1,
+    ):
+        self.frame_rate = frame_rate
+        self.on_loop_found = on_loop_found
+        self.chunk_size = chunk_size
+        self.step_size = step_size
+        self.window_size = MAXIMUM_LOOP_FRAMES // step_size
+
+        self.hash_matrix = np.empty((0, HASH_WORDS), dtype=np.uint64)
+        self.frame_numbers = np.empty(0, dtype=np.int64)
+        self.motion = np.empty(0, dtype=np.float32)
+        self.context_rows = 0  # Rows before the first start frame that's left, only kept for scene cut detection
+        self.selector = CandidateSelector()
+
+        # Chunks being searched by the pool, in start frame order
+        self.search_pool = multiprocessing.Pool(workers) if workers > 1 else None
+        self.searched_chunks = deque()
+
+    def add(self, frame_numbers, hashes, motion):
+        """Adds a batch of (frame_numbers x HASH_WORDS) packed hashes & their motion energy, in frame order"""
+        self.hash_matrix = np.concatenate([self.hash_matrix, hashes])
+        self.frame_numbers = np.concatenate(
+            [self.frame_numbers, np.asarray(frame_numbers, dtype=np.int64)]
+        )
+        self.motion = np.concatenate([self.motion, motion])
+
+        complete_starts = (
+            len(self.frame_numbers) - self.context_rows - self.window_size - SCENE_CUT_WINDOW
+        )
+
+        if complete_starts >= self.chunk_size:
+            self.finalize(complete_starts)
+
+    def finalize(self, number_of_starts):
+        """Finds the loops of the next `number_of_starts` start frames, then drops them from the window"""
+        first_row = self.context_rows
+        rows = min(first_row + number_of_starts + self.window_size, len(self.frame_numbers))
+        shot_ids = None
+
+        if SCENE_CUTS:
+            context_end = min(rows + SCENE_CUT_WINDOW, len(self.frame_numbers))
+            shot_ids = get_shot_ids(self.hash_matrix[:context_end])[first_row:rows]
+
+        # The window arrays are replaced rather than changed in place, so the chunk can still be read from them
+        chunk = (
+            self.hash_matrix[first_row:rows],
+            self.frame_numbers[first_row:rows],
+            self.step_size,
+            self.motion[first_row:rows],
+            shot_ids,
+            number_of_starts,
+            self.frame_rate,
+        )
+
+        if self.search_pool is not None:
+            self.searched_chunks.append(self.search_pool.apply_async(search_chunk, chunk))
+        else:
+            self.add_candidates(search_chunk(*chunk))
+
+        dropped_rows = max(first_row + number_of_starts - SCENE_CUT_WINDOW, 0)
+        self.context_rows = first_row + number_of_starts - dropped_rows
+
+        self.hash_matrix = self.hash_matrix[dropped_rows:]
+        self.frame_numbers = self.frame_numbers[dropped_rows:]
+        self.motion = self.motion[dropped_rows:]
+
+        self.collect_searched_chunks()
+
+    def collect_searched_chunks(self, wait=False):
+        """Adds the loops of the chunks the pool is done searching, in order. With `wait`, waits for all of them"""
+        while self.searched_chunks and (wait or self.searched_chunks[0].ready()):
+            self.add_candidates(self.searched_chunks.popleft().get())
+
+    def add_candidates(self, new_candidates):
+        for candidate in new_candidates:
+            self.selector.push(candidate)
+
+            if self.on_loop_found is not None:
+                self.on_loop_found(candidate)
+
+    def best_so_far(self):
+        return self.selector.select()
+
+    def finish(self):
+        """Finalizes the remaining start frames once there are no more hashes
+
+        :return: the best distinct loops, best first
+        """
+        self.finalize(len(self.frame_numbers) - self.context_rows)
+        self.collect_searched_chunks(wait=True)
+        self.close()
+
+        return self.selector.select()
+
+    def close(self):
+        if self.search_pool is not None:
+            self.search_pool.terminate()
+            self.search_pool.join()
+            self.search_pool = None
+
+
+class FrameHashCache(object):
+    """On-disk cache of the packed hashes & motion energy of a video, keyed by its content and the hashing parameters
+
+    An entry is a folder holding memory-mapped `hashes.npy`, `motion.npy` and `present.npy` arrays, indexed by
+    frame_number // step_size, so any sampled frame that was hashed before, by any job, is read back instead of being
+    decoded again. The folder's mtime is its last use, which `evict_hash_cache` goes by.
+
+    Hashes read from something made out of the video, like its analysis proxy, are still cached under the video's own
+    content & frame numbers, with a `variant` telling what they were read from. That way they're found again no matter
+    which window of the video the proxy was made for.
+
+    The entry is created & loaded under its lock, so jobs on the same video all map the same files, and it's marked
+    as in use until `close`, so it isn't evicted in the meantime.
+    """
+
+    def __init__(
+        self, video_path, step_size, number_of_frames, cache_folder=HASH_CACHE_FOLDER, variant=""
+    ):
+        self.step_size = step_size
+
+        hashing_parameters = (
+            f"{HASH_SIZE}:{HASH_INPUT_SIZE}:{FRAME_READER}:{step_size}:{MOTION_THUMBNAIL_SIZE}:{variant}"
+        )
+        self.entry_path = os.path.join(
+            cache_folder, get_file_digest(video_path, hashing_parameters)
+        )
+        self.hashes, self.motion, self.present = self.open_entry(
+            -(-number_of_frames // step_size)
+        )
+
+    def open_entry(self, number_of_samples):
+        hashes_path = os.path.join(self.entry_path, "hashes.npy")
+        motion_path = os.path.join(self.entry_path, "motion.npy")
+        present_path = os.path.join(self.entry_path, "present.npy")
+
+        with lock_cache_entry(self.entry_path):
+
+            # `present.npy` is moved in last, so an entry that has it is complete
+            if not os.path.exists(present_path):
+                for path, dtype, shape in (
+                    (hashes_path, np.uint64, (number_of_samples, HASH_WORDS)),
+                    (motion_path, np.float32, (number_of_samples,)),
+                    (present_path, bool, (number_of_samples,)),
+                ):
+                    temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    np.lib.format.open_memmap(temporary_path, "w+", dtype, shape).flush()
+                    os.replace(temporary_path, path)
+
+            # Mark the entry as used
+            os.utime(self.entry_path)
+            self.in_use_file = use_cache_entry(self.entry_path)
+
+            return (
+                np.load(hashes_path, mmap_mode="r+"),
+                np.load(motion_path, mmap_mode="r+"),
+                np.load(present_path, mmap_mode="r+"),
+            )
+
+    def runs(self, start_frame, end_frame):
+        """Splits the sampled frames in [start_frame, end_frame) into runs that are all cached, or all missing
+
+        :return: list of (run_start_frame, run_end_frame, is_cached)
+        """
+        first_sample = -(-start_frame // self.step_size)
+        end_sample = -(-end_frame // self.step_size)
+
+        if end_sample <= first_sample:
+            return []
+
+        present = np.zeros(end_sample - first_sample, dtype=bool)
+        cached_samples = self.present[first_sample:end_sample]
+        present[: len(cached_samples)] = cached_samples
+
+        run_edges = [0, *(np.flatnonzero(np.diff(present)) + 1), len(present)]
+
+        return [
+            (
+                max((first_sample + run_start) * self.step_size, start_frame),
+                min((first_sample + run_end) * self.step_size, end_frame),
+                bool(present[run_start]),
+            )
+            for run_start, run_end in zip(run_edges, run_edges[1:])
+        ]
+
+    def read(self, start_frame, end_frame, batch_size=HASH_BATCH_SIZE):
+        """Yields the cached (frame_numbers, packed hashes, motion) in [start_frame, end_frame), in batches"""
+        samples = range(-(-start_frame // self.step_size), -(-end_frame // self.step_size))
+
+        for batch_start in range(samples.start, samples.stop, batch_size):
+            batch_end = min(batch_start + batch_size, samples.stop)
+            frame_numbers = np.arange(batch_start, batch_end, dtype=np.int64) * self.step_size
+
+            yield (
+                frame_numbers,
+                np.array(self.hashes[batch_start:batch_end]),
+                np.array(self.motion[batch_start:batch_end]),
+            )
+
+    def store(self, frame_numbers, hashes, motion):
+        samples = np.asarray(frame_numbers, dtype=np.int64) // self.step_size
+        in_entry = samples < len(self.present)
+
+        self.hashes[samples[in_entry]] = hashes[in_entry]
+        self.motion[samples[in_entry]] = motion[in_entry]
+        self.present[samples[in_entry]] = True
+
+    def close(self):
+        self.hashes.flush()
+        self.motion.flush()
+        self.present.flush()
+        self.in_use_file.close()
+
 
 class InvalidIntervalException(Exception):
     """Thrown when module called with invalid start and end timestamps"""
@@ -107,18 +844,20 @@ class InvalidIntervalException(Exception):
 # Clean up the various files & folders we generated at the start of the loop creation process
 # TODO should put all temporary files into a single directory that can be either deleted or not based on a `DEBUG_MODE`
 #  flag
-def clean_up_folders(temp_frames_folder, frame_directory_path, path_of_source_video):
+def clean_up_folders(
+    temp_frames_folder,
+    frame_directory_path,
+    path_of_source_video,
+    intermediate_files=(),
+):
 
     if DEBUG_MODE:
         return
 
     folders_to_remove = [temp_frames_folder, frame_directory_path]
 
-    vector_file = os.path.join(
-        os.path.dirname(path_of_source_video), "transform_vectors.trf"
-    )
-
-    files_to_remove = [vector_file, path_of_source_video]
+    # Unless it's been moved out of the way to render lazily rendered loops from
+    files_to_remove = [*intermediate_files, path_of_source_video]
 
     for folder in folders_to_remove:
         try:
@@ -135,53 +874,179 @@ def clean_up_folders(temp_frames_folder, frame_directory_path, path_of_source_vi
 
 #######################################################################################################################
 
-# Get how long the video is
-def get_duration(video_path):
+def probe(video_path):
+    """Finds out everything the pipeline needs to know about a video, with a single ffprobe call
+
+    Results are memoized per path & modification time, so every stage can call this instead of probing again
+
+    :param video_path: path of the video
+
+    :return: MediaInfo of the video
+    """
+    return _probe(video_path, os.stat(video_path).st_mtime_ns)
+
+
+@lru_cache(maxsize=32)
+def _probe(video_path, modified_time):
 
     command = [
         "ffprobe",
         "-v",
         "error",
+        "-select_streams",
+        "v:0",
         "-show_entries",
-        "format=duration",
+        "format=duration:stream=codec_name,width,height,r_frame_rate,avg_frame_rate:packet=pts_time",
         "-of",
-        "default=noprint_wrappers=1:nokey=1",
+        "json",
         video_path,
     ]
 
-    duration_string = subprocess.check_output(command, encoding="UTF-8")
+    probe_result = json.loads(subprocess.check_output(command, encoding="UTF-8"))
+
+    stream = probe_result["streams"][0]
+    packets = probe_result.get("packets", [])
 
-    duration = float(duration_string)
+    # ffmpeg reports frame rates like 30000/1001, or 0/0 if it doesn't know
+    real_frame_rate = parse_frame_rate(stream.get("r_frame_rate"))
+    average_frame_rate = parse_frame_rate(stream.get("avg_frame_rate"))
 
-    return duration
+    # The "real" frame rate of a variable frame rate video is just one its timestamps fit on, which can be a lot higher
+    # than how many frames it has per second. So frame numbers are counted at the average frame rate for those
+    variable_frame_rate = bool(average_frame_rate and real_frame_rate) and average_frame_rate != real_frame_rate
+    frame_rate = average_frame_rate if variable_frame_rate else real_frame_rate or average_frame_rate
+
+    return MediaInfo(
+        duration=float(probe_result["format"]["duration"]),
+        frame_rate=frame_rate,
+        variable_frame_rate=variable_frame_rate,
+        frame_count=len(packets),
+        codec_name=stream.get("codec_name"),
+        width=stream.get("width"),
+        height=stream.get("height"),
+    )
+
+
+# Parse a frame rate like ffmpeg reports it, e.g. 30000/1001, into a Fraction. 0/0 means it's unknown
+def parse_frame_rate(frame_rate_string):
+
+    if not frame_rate_string:
+        return None
+
+    numerator, denominator = frame_rate_string.split("/")
+
+    if int(denominator) == 0:
+        return None
+
+    return Fraction(int(numerator), int(denominator))
 
 
 #######################################################################################################################
 
 
-# Due to complications with start/end time, we need this fps function for number of frames calculation
-def get_frame_rate(video_path):
+# Digest of a file's content, plus any extra text that should be part of the key
+def get_file_digest(path, extra=""):
+    digest = hashlib.sha256()
 
-    command = [
-        "ffprobe",
-        "-v",
-        "0",
-        "-of",
-        "csv=p=0",
-        "-select_streams",
-        "V:0",
-        "-show_entries",
-        "stream=r_frame_rate",
-        video_path,
-    ]
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
 
-    frame_rate_string = subprocess.check_output(command, encoding="UTF-8")
+    digest.update(extra.encode("UTF-8"))
 
-    # ffmpeg will report like 30000/1000
-    num, div = frame_rate_string.split("/")
-    frame_rate = int(num) / int(div)
+    return digest.hexdigest()
 
-    return frame_rate
+
+#######################################################################################################################
+
+
+def lock_cache_entry(entry_path):
+    """Creates the hash cache entry folder if it's missing, and exclusively locks it
+
+    Nothing else can create, load or evict the entry until the lock is released. To keep using it after that, mark
+    it with `use_cache_entry` while still holding the lock.
+
+    :return: the locked lock file of the entry, closing it releases the lock
+    """
+    while True:
+        os.makedirs(entry_path, exist_ok=True)
+
+        try:
+            lock_file = open(os.path.join(entry_path, CACHE_ENTRY_LOCK_NAME), "a")
+        except FileNotFoundError:
+            # Evicted right after it was created, so create it again
+            continue
+
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        # The entry might have been evicted while we waited for the lock, then we'd hold the lock of a removed file
+        try:
+            if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_file.name).st_ino:
+                return lock_file
+        except FileNotFoundError:
+            pass
+
+        lock_file.close()
+
+
+# Mark a hash cache entry as in use, so it isn't evicted until the returned file is closed. Only call it while holding
+# the entry's lock, see `lock_cache_entry`
+def use_cache_entry(entry_path):
+
+    in_use_file = open(os.path.join(entry_path, CACHE_ENTRY_IN_USE_NAME), "a")
+    fcntl.flock(in_use_file, fcntl.LOCK_SH)
+
+    return in_use_file
+
+
+#######################################################################################################################
+
+
+# Remove the least recently used hash cache entries until the cache fits in `max_bytes`, never removing `keep`, or
+# entries that are in use
+def evict_hash_cache(cache_folder=HASH_CACHE_FOLDER, max_bytes=HASH_CACHE_MAX_BYTES, keep=None):
+
+    entries = []
+
+    for entry in os.scandir(cache_folder):
+        if not entry.is_dir():
+            continue
+
+        try:
+            size = sum(file.stat().st_size for file in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+        except FileNotFoundError:
+            # Evicted by another worker in the meantime
+            continue
+
+    total_size = sum(size for _, size, _ in entries)
+
+    for _, size, entry_path in sorted(entries):
+        if total_size <= max_bytes:
+            break
+
+        if entry_path == keep:
+            continue
+
+        lock_path = os.path.join(entry_path, CACHE_ENTRY_LOCK_NAME)
+        in_use_path = os.path.join(entry_path, CACHE_ENTRY_IN_USE_NAME)
+
+        try:
+            with open(lock_path, "a") as lock_file, open(in_use_path, "a") as in_use_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    fcntl.flock(in_use_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Some job is using it
+                    continue
+
+                logger.info(f"Evicting hash cache entry {entry_path}")
+                shutil.rmtree(entry_path, ignore_errors=True)
+        except FileNotFoundError:
+            # Evicted by another worker in the meantime
+            pass
+
+        total_size -= size
 
 
 #######################################################################################################################
@@ -197,452 +1062,1822 @@ def create_directories(*paths):
 #######################################################################################################################
 
 
-# Calculate stabilization vectors --> Stabilize video
-def resize_video(path_of_source_video, resized_video_path, callback):
+def make_analysis_proxy(
+    path_of_source_video, proxy_path, start_frame, end_frame, frame_rate, callback
+):
+    """Transcodes the frames from `start_frame` up to `end_frame` of the video into a small proxy to analyze
 
-    # Now we can use libvidstab to stabilize video using the .trf vector file we just created
-    resize_command = [
+    Frames are squashed to HASH_INPUT_SIZE on both sides, which is all that hashing looks at, so decoding the proxy is
+    cheap whatever resolution the source has. Frame 0 of the proxy is `start_frame` of the video.
+    """
+    start_time = start_frame / frame_rate
+    duration = (end_frame - start_frame) / frame_rate
+
+    callback("Preparing to search...", 30)
+
+    proxy_command = [
         "ffmpeg",
         "-y",
+        "-ss",
+        str(start_time),
+        "-t",
+        str(duration),
         "-i",
         path_of_source_video,
         "-vf",
-        f"scale={LOOP_WIDTH}:-2",
+        f"scale={HASH_INPUT_SIZE}:{HASH_INPUT_SIZE}:flags=lanczos",
+        "-an",
+        "-c:v",
+        "libx264",
+        "-preset",
+        "ultrafast",
         "-crf",
-        "20",
-        resized_video_path,
+        str(ANALYSIS_PROXY_CRF),
     ]
 
-    stabilize_progress = 0
-
-    callback("Resizing video...", stabilize_progress)
+    # Written next to it first, so that a cached proxy is always complete
+    partial_proxy_path = os.path.join(
+        os.path.dirname(proxy_path), "partial_" + os.path.basename(proxy_path)
+    )
 
-    # run the command
-    subprocess.run(resize_command)
-    stabilize_progress += 10
-    callback("Resizing video...", stabilize_progress)
+    subprocess.run([*proxy_command, partial_proxy_path], check=True)
+    os.replace(partial_proxy_path, proxy_path)
 
-    return resized_video_path
+    return proxy_path
 
 
-# Calculate stabilization vectors --> Stabilize video
-def stabilize_video(
-    path_of_source_video, stable_video_path, start_time, end_time, callback
+def cached_analysis_proxy(
+    entry_path, video_path, video_start_frame, start_frame, end_frame, frame_rate, callback
 ):
+    """Finds an analysis proxy of the frames from `start_frame` up to `end_frame` in a hash cache entry, or makes one
 
-    folder_of_source_video = os.path.dirname(path_of_source_video)
-    duration = end_time - start_time
+    Any proxy in the entry that covers those frames will do. The entry stays locked meanwhile, so jobs on the same
+    video wait for each other's proxy instead of making it again.
 
-    # Prior to stabilizing the video, we'll need to calculate the stabilization vectors we need
-    calculate_vector_command = [
-        "ffmpeg",
-        "-y",
-        "-threads",
-        "8",
-        "-i",
-        "{}".format(path_of_source_video),
-        "-vf",
-        "vidstabdetect=stepsize=6:shakiness=4:accuracy=5:"
-        "result={}/transform_vectors.trf".format(os.path.dirname(path_of_source_video)),
-        "-f",
-        "null",
-        "-",
-    ]
+    :param video_start_frame: the frame of the source video that frame 0 of `video_path` is
 
-    # Now we can use libvidstab to stabilize video using the .trf vector file we just created
-    stabilize_command = [
+    :return: (path of the proxy, the frame of the source video that frame 0 of the proxy is)
+    """
+    with lock_cache_entry(entry_path):
+        for file_name in os.listdir(entry_path):
+            proxy_match = re.fullmatch(r"proxy_(\d+)_(\d+)\.mkv", file_name)
+
+            if proxy_match is not None:
+                proxy_start_frame, proxy_end_frame = map(int, proxy_match.groups())
+
+                if proxy_start_frame <= start_frame and proxy_end_frame >= end_frame:
+                    return os.path.join(entry_path, file_name), proxy_start_frame
+
+        proxy_path = make_analysis_proxy(
+            video_path,
+            os.path.join(entry_path, f"proxy_{start_frame}_{end_frame}.mkv"),
+            start_frame - video_start_frame,
+            end_frame - video_start_frame,
+            frame_rate,
+            callback,
+        )
+
+    return proxy_path, start_frame
+
+
+def make_mezzanine(
+    path_of_source_video, mezzanine_path, start_frame, end_frame, frame_rate, sound_enabled
+):
+    """Transcodes the frames from `start_frame` up to `end_frame` of the source video into an all-intra mezzanine
+
+    It's scaled down to LOOP_WIDTH & every frame is a keyframe, so loops can be encoded from it with exact, cheap
+    seeks.
+
+    :return: the time in the source video that the mezzanine starts at
+    """
+    start_time = start_frame / frame_rate
+    duration = (end_frame - start_frame) / frame_rate
+
+    mezzanine_command = [
         "ffmpeg",
-        "-threads",
-        "8",
         "-y",
-        "-i",
-        path_of_source_video,
         "-ss",
         str(start_time),
         "-t",
         str(duration),
+        "-i",
+        path_of_source_video,
         "-vf",
-        "vidstabtransform=input={}/transform_vectors.trf:"
-        "zoom=1:smoothing=30,unsharp=5:5:0.8:3:3:0.4".format(
-            folder_of_source_video, LOOP_WIDTH
+        f"scale={LOOP_WIDTH}:-2",
+        "-c:v",
+        "libx264",
+        "-preset",
+        "ultrafast",
+        "-g",
+        "1",
+        "-crf",
+        str(MEZZANINE_CRF),
+    ]
+
+    # Keep the audio lossless, the loops get their own audio encodes
+    if sound_enabled:
+        mezzanine_command.extend(["-c:a", "pcm_s16le"])
+    else:
+        mezzanine_command.append("-an")
+
+    mezzanine_command.append(mezzanine_path)
+
+    subprocess.run(mezzanine_command, check=True)
+
+    return start_time
+
+
+# Calculate stabilization vectors --> Stabilize video
+def stabilize_video(
+    path_of_source_video,
+    stable_video_path,
+    start_frame,
+    end_frame,
+    frame_rate,
+    sound_enabled,
+    callback,
+):
+    """Stabilizes the frames from `start_frame` up to `end_frame` of the source video into an all-intra video
+
+    Both passes only read that window, scaled down to LOOP_WIDTH, which is the size the loops are made at anyway. The
+    transform vectors are cached per source video & window, so stabilizing the same window again only applies them.
+    Like the mezzanine, the stabilized video has every frame as a keyframe, so loops can be encoded from it directly.
+
+    :return: the time in the source video that the stabilized video starts at
+    """
+    start_time = start_frame / frame_rate
+    duration = (end_frame - start_frame) / frame_rate
+
+    window_input = ["-ss", str(start_time), "-t", str(duration), "-i", path_of_source_video]
+
+    os.makedirs(HASH_CACHE_FOLDER, exist_ok=True)
+
+    cache_entry = os.path.join(
+        HASH_CACHE_FOLDER,
+        get_file_digest(
+            path_of_source_video,
+            f"vidstab:{start_frame}:{end_frame}:{LOOP_WIDTH}:{STABILIZE_DETECT_OPTIONS}",
         ),
-        "-vcodec",
+    )
+    vector_file = os.path.join(cache_entry, "transform_vectors.trf")
+
+    callback("Stabilizing video...", 0)
+
+    # Concurrent jobs stabilizing the same window wait for the first one's vectors, instead of detecting them again
+    with lock_cache_entry(cache_entry):
+        if os.path.exists(vector_file):
+            # Mark the entry as recently used
+            os.utime(cache_entry)
+        else:
+            # Written next to it first, so that a vector file in the cache is always complete
+            partial_vector_file = os.path.join(cache_entry, "partial_transform_vectors.trf")
+
+            # Prior to stabilizing the video, we'll need to calculate the stabilization vectors we need
+            calculate_vector_command = [
+                "ffmpeg",
+                "-y",
+                "-threads",
+                str(STABILIZE_THREADS),
+                *window_input,
+                "-vf",
+                f"scale={LOOP_WIDTH}:-2,"
+                f"vidstabdetect={STABILIZE_DETECT_OPTIONS}:result={partial_vector_file}",
+                "-f",
+                "null",
+                "-",
+            ]
+
+            subprocess.run(calculate_vector_command, check=True)
+            os.replace(partial_vector_file, vector_file)
+
+        # Keeps the vectors from being evicted while they're applied
+        in_use_file = use_cache_entry(cache_entry)
+
+    callback("Stabilizing video...", 10)
+
+    # Now we can use libvidstab to stabilize video using the .trf vector file we just created
+    stabilize_command = [
+        "ffmpeg",
+        "-y",
+        "-threads",
+        str(STABILIZE_THREADS),
+        *window_input,
+        "-vf",
+        f"scale={LOOP_WIDTH}:-2,"
+        f"vidstabtransform=input={vector_file}:zoom=1:smoothing=30,unsharp=5:5:0.8:3:3:0.4",
+        "-c:v",
         "libx264",
-        "-acodec",
-        "copy",
         "-preset",
-        "fast",
-        "-tune",
-        "film",
+        "ultrafast",
+        "-g",
+        "1",
         "-crf",
-        "17",
-        "-acodec",
-        "copy",
+        str(MEZZANINE_CRF),
+    ]
+
+    if sound_enabled:
+        stabilize_command.extend(["-c:a", "pcm_s16le"])
+    else:
+        stabilize_command.append("-an")
+
+    stabilize_command.append(stable_video_path)
+
+    try:
+        subprocess.run(stabilize_command, check=True)
+    finally:
+        in_use_file.close()
+
+    callback("Stabilizing video...", 20)
+
+    evict_hash_cache(keep=cache_entry)
+
+    return start_time
+
+
+#######################################################################################################################
+
+
+# How much two loops overlap, as the intersection over union of their frame intervals
+def loop_overlap(candidate, other):
+
+    intersection = min(candidate.end_frame_number, other.end_frame_number) - max(
+        candidate.start_frame_number, other.start_frame_number
+    )
+    union = max(candidate.end_frame_number, other.end_frame_number) - min(
+        candidate.start_frame_number, other.start_frame_number
+    )
+
+    return max(intersection, 0) / union
+
+
+#######################################################################################################################
+
+
+# We'll use this to tell FFMPEG what kind of GIF/WEBM we want, i.e., give it correctly formatted parameters
+def prepare_webm_info(
+    candidate, webm_destination_folder, stable_video_path, sound_enabled, counter
+):
+
+    webm_name = "{}.webm".format(counter)
+    webm_destination = os.path.join(webm_destination_folder, webm_name)
+    webm_encode_command = [
+        "ffmpeg",
+        "-y",
+        "-ss",
+        str(candidate.seek_time),
+        "-t",
+        str(candidate.duration),
+        "-i",
+        stable_video_path,
+    ]
+
+    if not sound_enabled:
+        webm_encode_command.append("-an")
+
+    # This part of command will then process all frames in temp directory to output to GIF/WEBM
+    webm_encode_command.extend(
+        [
+            "-minrate",
+            "1700k",
+            "-b:v",
+            "1800K",
+            "-maxrate",
+            "2000K",
+            "-c:v",
+            "libvpx",
+            "-threads",
+            str(ENCODE_THREADS),
+            "-vf",
+            "scale=500:-2",
+            webm_destination,
+        ]
+    )
+
+    candidate.webm_encode_command = webm_encode_command
+    candidate.webm_name = webm_name
+
+    return candidate
+
+
+#######################################################################################################################
+
+
+def prepare_gif_info(
+    candidate, webm_destination_folder, stable_video_path, frame_directory_path, counter
+):
+
+    gif_name = "{}.gif".format(counter)
+    gif_destination = os.path.join(webm_destination_folder, gif_name)
+    # Each loop gets its own palette, since loops are encoded concurrently
+    palette_destination = os.path.join(frame_directory_path, "palette_{}.png".format(counter))
+
+    gif_palette_command = [
+        "ffmpeg",
+        "-y",
+        "-ss",
+        str(candidate.seek_time),
+        "-t",
+        str(candidate.duration),
+        "-i",
+        stable_video_path,
+        "-vf",
+        "scale=500:-2:flags=lanczos,palettegen",
+        palette_destination,
+    ]
+
+    gif_encode_command = [
+        "ffmpeg",
+        "-y",
+        "-ss",
+        str(candidate.seek_time),
+        "-t",
+        str(candidate.duration),
+        "-i",
+        stable_video_path,
+        "-i",
+        palette_destination,
+        "-filter_complex",
+        "fps=25,scale=500:-2:flags=lanczos[x];[x][1:v]paletteuse",
+        gif_destination,
+    ]
+
+    candidate.gif_palette_command = gif_palette_command
+    candidate.gif_encode_command = gif_encode_command
+    candidate.gif_name = gif_name
+
+    return candidate
+
+
+#######################################################################################################################
+
+
+def prepare_mp4_info(
+    candidate, webm_destination_folder, stable_video_path, sound_enabled, counter
+):
+
+    mp4_name = "{}.mp4".format(counter)
+    mp4_destination = os.path.join(webm_destination_folder, mp4_name)
+
+    mp4_encode_command = [
+        "ffmpeg",
+        "-y",
+        "-ss",
+        str(candidate.seek_time),
+        "-t",
+        str(candidate.duration),
+        "-i",
+        stable_video_path,
+        "-an",
+        "-b:v",
+        "1800K",
+        "-c:v",
+        "libx264",
+        "-threads",
+        str(ENCODE_THREADS),
+        "-vf",
+        "scale=500:-2",
+        mp4_destination,
+    ]
+
+    if sound_enabled:
+        mp4_encode_command.remove("-an")
+
+    candidate.mp4_encode_command = mp4_encode_command
+    candidate.mp4_name = mp4_name
+
+    return candidate
+
+
+#######################################################################################################################
+
+
+def prepare_combined_info(
+    candidate,
+    webm_destination_folder,
+    stable_video_path,
+    sound_enabled,
+    counter,
+    formats=("webm", "mp4", "gif"),
+):
+    """Builds a single ffmpeg command that decodes the loop once, and writes it in each of `formats`
+
+    The decoded frames are split between the outputs inside the filter graph. Each branch runs the same filters as
+    the matching `prepare_*_info` command, so the outputs are the same as with ENCODE_MODE "separate". The gif
+    palette is generated from its own branch, and paletteuse waits for it, so no palette file is needed.
+    """
+    webm_name = "{}.webm".format(counter)
+    gif_name = "{}.gif".format(counter)
+    mp4_name = "{}.mp4".format(counter)
+
+    # Audio is optional, the source might not have any
+    audio_map = ["-map", "0:a?"] if sound_enabled else ["-an"]
+
+    split_outputs = []
+    filter_branches = []
+    output_options = []
+
+    if "webm" in formats:
+        split_outputs.append("[webm_in]")
+        filter_branches.append(f"[webm_in]scale={LOOP_WIDTH}:-2[webm]")
+        output_options.extend(
+            [
+                "-map",
+                "[webm]",
+                *audio_map,
+                "-minrate",
+                "1700k",
+                "-b:v",
+                "1800K",
+                "-maxrate",
+                "2000K",
+                "-c:v",
+                "libvpx",
+                "-threads",
+                str(ENCODE_THREADS),
+                os.path.join(webm_destination_folder, webm_name),
+            ]
+        )
+
+    if "mp4" in formats:
+        split_outputs.append("[mp4_in]")
+        filter_branches.append(f"[mp4_in]scale={LOOP_WIDTH}:-2[mp4]")
+        output_options.extend(
+            [
+                "-map",
+                "[mp4]",
+                *audio_map,
+                "-b:v",
+                "1800K",
+                "-c:v",
+                "libx264",
+                "-threads",
+                str(ENCODE_THREADS),
+                os.path.join(webm_destination_folder, mp4_name),
+            ]
+        )
+
+    if "gif" in formats:
+        split_outputs.extend(["[palette_in]", "[gif_in]"])
+        filter_branches.extend(
+            [
+                f"[palette_in]scale={LOOP_WIDTH}:-2:flags=lanczos,palettegen[palette]",
+                f"[gif_in]fps=25,scale={LOOP_WIDTH}:-2:flags=lanczos[gif_frames]",
+                "[gif_frames][palette]paletteuse[gif]",
+            ]
+        )
+        output_options.extend(
+            ["-map", "[gif]", os.path.join(webm_destination_folder, gif_name)]
+        )
+
+    filter_graph = ";".join(
+        [f"[0:v]split={len(split_outputs)}{''.join(split_outputs)}", *filter_branches]
+    )
+
+    combined_encode_command = [
+        "ffmpeg",
+        "-y",
+        "-ss",
+        str(candidate.seek_time),
+        "-t",
+        str(candidate.duration),
+        "-i",
         stable_video_path,
+        "-filter_complex",
+        filter_graph,
+        *output_options,
     ]
 
-    stabilize_progress = 0
+    candidate.combined_encode_command = combined_encode_command
+    candidate.webm_name = webm_name
+    candidate.gif_name = gif_name
+    candidate.mp4_name = mp4_name
+
+    return candidate
+
+
+#######################################################################################################################
+
+
+# Runs on an encoding thread: the encode commands of a loop have to run one after the other
+def encode_candidate(candidate):
+    for command in candidate.encode_commands():
+        subprocess.run(command)
+
+
+#######################################################################################################################
+
+
+# We'll clean/populate the temp directory and then create the loops from list of sorted candidates. Loops are encoded
+# concurrently, within ENCODE_CPU_BUDGET. Progress is reported from the calling thread as they finish
+def create_candidate_loops(best_webm_candidates, callback):
+
+    candidates_to_encode = best_webm_candidates[:NUMBER_WEBMS_TO_MAKE]
+    percent_per_webm = 20 / NUMBER_WEBMS_TO_MAKE
+    encode_progress = 80
+
+    callback("Encoding webms...", encode_progress)
+
+    if not candidates_to_encode:
+        return
+
+    encode_workers = min(max(ENCODE_CPU_BUDGET // ENCODE_THREADS, 1), len(candidates_to_encode))
+
+    with ThreadPoolExecutor(max_workers=encode_workers) as encode_pool:
+        encode_futures = [
+            encode_pool.submit(encode_candidate, candidate) for candidate in candidates_to_encode
+        ]
+
+        for encode_future in as_completed(encode_futures):
+            encode_future.result()
+
+            encode_progress = encode_progress + percent_per_webm
+
+            callback("Encoding webms...", encode_progress)
+
+
+#######################################################################################################################
+
+
+def add_info_to_candidates(
+    best_webm_candidates,
+    webm_destination_folder,
+    stable_video_path,
+    frame_directory_path,
+    sound_enabled,
+    formats=("webm", "gif", "mp4"),
+    source_start_time=0.0,
+):
+
+    for counter, candidate in enumerate(best_webm_candidates, 1):
+
+        # `stable_video_path` might only be a part of the source video, starting at `source_start_time`
+        if candidate.source_path is None:
+            candidate.source_start_time = source_start_time
+
+        loop_source_path = candidate.source_path or stable_video_path
+
+        if ENCODE_MODE == "single":
+            prepare_combined_info(
+                candidate,
+                webm_destination_folder,
+                loop_source_path,
+                sound_enabled,
+                counter,
+                formats,
+            )
+            continue
+
+        # Formats that aren't encoded now still get their names, to be rendered under later
+        candidate.webm_name = "{}.webm".format(counter)
+        candidate.gif_name = "{}.gif".format(counter)
+        candidate.mp4_name = "{}.mp4".format(counter)
+
+        if "webm" in formats:
+            prepare_webm_info(
+                candidate,
+                webm_destination_folder,
+                loop_source_path,
+                sound_enabled,
+                counter,
+            )
+        if "gif" in formats:
+            prepare_gif_info(
+                candidate,
+                webm_destination_folder,
+                loop_source_path,
+                frame_directory_path,
+                counter,
+            )
+        if "mp4" in formats:
+            prepare_mp4_info(
+                candidate,
+                webm_destination_folder,
+                loop_source_path,
+                sound_enabled,
+                counter,
+            )
+
+    return best_webm_candidates
+
+
+#######################################################################################################################
+
+
+# Where the job whose loops are in `webm_destination_folder` keeps what's needed to render them lazily
+def get_render_source_folder(webm_destination_folder):
+
+    job_folder = os.path.dirname(os.path.abspath(webm_destination_folder))
+
+    return os.path.join(RENDER_SOURCE_FOLDER, os.path.basename(job_folder))
+
+
+#######################################################################################################################
+
+
+def keep_render_source(
+    best_webm_candidates,
+    webm_destination_folder,
+    path_of_source_video,
+    sound_enabled,
+    source_start_time=0.0,
+):
+    """Moves the source video out of the job folder, to render the loops that weren't encoded yet from
+
+    It goes in the job's folder of RENDER_SOURCE_FOLDER, along with the RENDER_INFO_FILE `render_lazy_loop` goes by.
+    That folder replaces any left over by an earlier job with the same job folder.
+
+    :return: the new path of the source video
+    """
+    render_source_folder = get_render_source_folder(webm_destination_folder)
+    render_source_path = os.path.join(render_source_folder, os.path.basename(path_of_source_video))
+
+    render_info = {
+        "loops_folder": os.path.abspath(webm_destination_folder),
+        "source_video": os.path.basename(path_of_source_video),
+        "source_start_time": source_start_time,
+        "sound_enabled": sound_enabled,
+        "loops": {
+            str(counter): [
+                candidate.start_frame_number,
+                candidate.end_frame_number,
+                candidate.frame_rate,
+            ]
+            for counter, candidate in enumerate(best_webm_candidates, 1)
+        },
+    }
+
+    shutil.rmtree(render_source_folder, ignore_errors=True)
+    os.makedirs(render_source_folder)
+
+    # The render info goes first, so that a folder without it is never left behind, see `expire_render_sources`
+    with open(os.path.join(render_source_folder, RENDER_INFO_FILE), "w") as render_info_file:
+        json.dump(render_info, render_info_file)
+
+    shutil.move(path_of_source_video, render_source_path)
+
+    return render_source_path
+
+
+#######################################################################################################################
+
+
+def check_lazy_loop(webm_destination_folder, file_name):
+    """Checks that a file name is a loop of the job that can be rendered lazily, e.g. "2.gif"
+
+    :return: (render_info, counter, file_format) of the loop
+    """
+    name_match = re.fullmatch(r"(\d+)\.(\w+)", file_name)
+
+    if name_match is None or name_match.group(2) not in LAZY_FORMATS:
+        raise ValueError(f"{file_name} isn't a loop that can be rendered")
+
+    render_source_folder = get_render_source_folder(webm_destination_folder)
+
+    with open(os.path.join(render_source_folder, RENDER_INFO_FILE)) as render_info_file:
+        render_info = json.load(render_info_file)
+
+    counter, file_format = name_match.groups()
+
+    if counter not in render_info["loops"]:
+        raise FileNotFoundError(f"There's no loop {counter}")
+
+    return render_info, counter, file_format
+
+
+#######################################################################################################################
+
+
+def render_lazy_loop(webm_destination_folder, file_name):
+    """Renders a loop in one of the LAZY_FORMATS the first time it's asked for, e.g. "2.gif"
+
+    Meant to run on a worker, see the `render_loop` job. Concurrent renders of the same file wait on a lock for the
+    first one to finish, then find it rendered.
+    Loops are rendered in a temporary folder and moved in place once done, so a file that exists is complete.
+
+    :param webm_destination_folder: loops folder of the job
+    :param file_name: name of the loop file
+
+    :return: path of the rendered loop
+    """
+    loop_path = os.path.join(webm_destination_folder, file_name)
+
+    # Loops that are rendered don't need their render source anymore, which might have expired since
+    if os.path.exists(loop_path):
+        return loop_path
+
+    render_info, counter, file_format = check_lazy_loop(webm_destination_folder, file_name)
+
+    render_source_folder = get_render_source_folder(webm_destination_folder)
+    lock_path = os.path.join(render_source_folder, f".{file_name}.lock")
+
+    with open(lock_path, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        # Someone else might have rendered it while we waited
+        if os.path.exists(loop_path):
+            return loop_path
+
+        source_video = os.path.join(render_source_folder, render_info["source_video"])
+        candidate = CandidateLoop(0, *render_info["loops"][counter])
+        candidate.source_start_time = render_info["source_start_time"]
+        render_folder = tempfile.mkdtemp(dir=webm_destination_folder)
+
+        try:
+            if ENCODE_MODE == "single":
+                prepare_combined_info(
+                    candidate,
+                    render_folder,
+                    source_video,
+                    render_info["sound_enabled"],
+                    counter,
+                    (file_format,),
+                )
+            elif file_format == "gif":
+                prepare_gif_info(candidate, render_folder, source_video, render_folder, counter)
+            else:
+                prepare_mp4_info(
+                    candidate, render_folder, source_video, render_info["sound_enabled"], counter
+                )
+
+            logger.info(f"Rendering {loop_path}")
+
+            for command in candidate.encode_commands():
+                subprocess.run(command, check=True)
+
+            os.replace(os.path.join(render_folder, file_name), loop_path)
+        finally:
+            shutil.rmtree(render_folder, ignore_errors=True)
+
+    return loop_path
+
+
+#######################################################################################################################
+
+
+def expire_render_sources(
+    render_sources_folder=RENDER_SOURCE_FOLDER, ttl=RENDER_SOURCE_TTL, max_bytes=RENDER_SOURCE_MAX_BYTES
+):
+    """Removes the render sources of jobs that are more than `ttl` seconds old, and the oldest ones past `max_bytes`
+
+    The loops of a job that haven't been asked for yet are rendered first, so they're still there once its render
+    source is gone. Loops that fail to render are given up on. Meant to run on a worker, see the `expire_renders` job.
+
+    :param render_sources_folder: folder holding the render sources of every job
+    :param ttl: how long a job keeps its render source, counted from when the job was done
+    :param max_bytes: how much the render sources of all jobs can take
+    """
+    entries = []
+
+    if not os.path.isdir(render_sources_folder):
+        return
+
+    for entry in os.scandir(render_sources_folder):
+        if not entry.is_dir():
+            continue
+
+        try:
+            done_time = os.stat(os.path.join(entry.path, RENDER_INFO_FILE)).st_mtime
+            size = sum(file.stat().st_size for file in os.scandir(entry.path))
+            entries.append((done_time, size, entry.path))
+        except FileNotFoundError:
+            # Expired by another worker in the meantime
+            continue
+
+    total_size = sum(size for _, size, _ in entries)
+    expiry_time = time.time() - ttl
+
+    for done_time, size, entry_path in sorted(entries):
+        if done_time > expiry_time and total_size <= max_bytes:
+            break
+
+        try:
+            with open(os.path.join(entry_path, RENDER_INFO_FILE)) as render_info_file:
+                render_info = json.load(render_info_file)
+        except FileNotFoundError:
+            continue
+
+        for counter in render_info["loops"]:
+            for file_format in LAZY_FORMATS:
+                try:
+                    render_lazy_loop(render_info["loops_folder"], f"{counter}.{file_format}")
+                except Exception:
+                    logger.exception(f"Couldn't render {counter}.{file_format} of {render_info['loops_folder']}")
+
+        logger.info(f"Removing render source {entry_path}")
+        shutil.rmtree(entry_path, ignore_errors=True)
+
+        total_size -= size
+
+
+#######################################################################################################################
+
+
+# Constants for counting the set bits of uint64 words (numpy has no popcount ufunc before 2.0)
+_POPCOUNT_MASK_1 = np.uint64(0x5555555555555555)
+_POPCOUNT_MASK_2 = np.uint64(0x3333333333333333)
+_POPCOUNT_MASK_4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_POPCOUNT_MULTIPLIER = np.uint64(0x0101010101010101)
+
+
+def count_bits(words):
+    """Counts the set bits of every element of a uint64 array (SWAR popcount)"""
+    words = words - ((words >> np.uint64(1)) & _POPCOUNT_MASK_1)
+    words = (words & _POPCOUNT_MASK_2) + ((words >> np.uint64(2)) & _POPCOUNT_MASK_2)
+    words = (words + (words >> np.uint64(4))) & _POPCOUNT_MASK_4
+
+    return (words * _POPCOUNT_MULTIPLIER) >> np.uint64(56)
+
+
+#######################################################################################################################
+
+
+# Pack boolean hashes into a contiguous (frames x HASH_WORDS) uint64 matrix, so that the hamming distance
+# between any two frames is an XOR and a popcount over two rows
+def pack_hash_bits(hashes):
+
+    hash_bits = np.asarray(hashes, dtype=bool).reshape(len(hashes), HASH_SIZE ** 2)
+
+    return np.packbits(hash_bits, axis=1).view(np.uint64)
+
+
+#######################################################################################################################
+
+
+def hash_pyramid_level(hash_matrix, size):
+    """Packs the size x size lowest frequency corner of every packed hash, e.g. 8x8 into a single uint64 per frame
+
+    Each row of a hash is one uint64 word, so the corner is the first size / 8 bytes of the first `size` words
+    """
+    hash_bytes = hash_matrix.view(np.uint8).reshape(
+        len(hash_matrix), HASH_SIZE, HASH_SIZE // 8
+    )
+    corner = np.ascontiguousarray(hash_bytes[:, :size, : size // 8])
+
+    return corner.reshape(len(hash_matrix), size * size // 8).view(np.uint64)
+
+
+#######################################################################################################################
+
+
+def build_hash_pyramid(hash_matrix, cascade=HASH_CASCADE):
+    """:return: (packed pyramid level, max different bits) of each HASH_CASCADE_LEVELS entry, none without `cascade`"""
+    if not cascade:
+        return []
+
+    return [
+        (hash_pyramid_level(hash_matrix, size), size * size * max_difference)
+        for size, max_difference in HASH_CASCADE_LEVELS
+    ]
+
+
+#######################################################################################################################
+
+
+def pair_distances(hash_matrix, pyramid, first_rows, second_rows):
+    """Hamming distances between the hashes of rows first_rows[i] and second_rows[i] of `hash_matrix`
+
+    Pairs go through the `pyramid` levels first (see `build_hash_pyramid`), and those rejected by any of them are set
+    to MAX_HASH_DIFFERENCE without comparing their full hashes
+    """
+    distances = np.full(len(first_rows), MAX_HASH_DIFFERENCE, dtype=np.int64)
+    surviving = np.arange(len(first_rows))
+
+    for level_matrix, max_different_bits in pyramid:
+        level_bits = count_bits(
+            level_matrix[first_rows[surviving]] ^ level_matrix[second_rows[surviving]]
+        )
+        surviving = surviving[level_bits.sum(axis=1) <= max_different_bits]
+
+    different_bits = count_bits(
+        hash_matrix[first_rows[surviving]] ^ hash_matrix[second_rows[surviving]]
+    )
+    distances[surviving] = different_bits.sum(axis=1)
+
+    return distances
+
+
+#######################################################################################################################
+
+
+# Start frames followed by at least STATIC_RUN_FRAMES frames without motion, see MOTION_PREFILTER. The motion energy
+# of frame i is how much it changed since frame i - 1
+def get_static_starts(motion, step_size=SEARCH_STEP_SIZE):
+
+    run_length = -(-STATIC_RUN_FRAMES // step_size)
+    number_of_frames = len(motion)
+
+    # NaN motion is unknown, so never static
+    still_counts = np.concatenate([[0], np.cumsum(motion < STATIC_MOTION_THRESHOLD)])
+
+    starts = np.arange(number_of_frames)
+    run_ends = np.minimum(starts + run_length + 1, number_of_frames)
+
+    return (starts + run_length < number_of_frames) & (
+        still_counts[run_ends] - still_counts[np.minimum(starts + 1, number_of_frames)] == run_length
+    )
+
+
+#######################################################################################################################
+
+
+# Number every hashed frame with the shot it's in, shots being separated by cuts, see SCENE_CUTS
+def get_shot_ids(hash_matrix, threshold=SCENE_CUT_THRESHOLD, size=SCENE_CUT_HASH_SIZE):
+
+    if len(hash_matrix) < 2:
+        return np.zeros(len(hash_matrix), dtype=np.int64)
+
+    level_matrix = hash_pyramid_level(hash_matrix, size)
+    consecutive_bits = count_bits(level_matrix[1:] ^ level_matrix[:-1]).sum(axis=1)
+
+    # Median change around each pair of consecutive frames, over a sliding window
+    padded_bits = np.pad(consecutive_bits, SCENE_CUT_WINDOW, mode="edge")
+    windows = as_strided(
+        padded_bits,
+        (len(consecutive_bits), 2 * SCENE_CUT_WINDOW + 1),
+        (padded_bits.strides[0], padded_bits.strides[0]),
+    )
+    local_bits = np.median(windows, axis=1)
+
+    cuts = (consecutive_bits > size * size * threshold) & (
+        consecutive_bits > local_bits * SCENE_CUT_CONTRAST
+    )
+
+    return np.concatenate([[0], np.cumsum(cuts)])
+
+
+#######################################################################################################################
+
+
+def hamming_distances(
+    hash_matrix, max_offset, cascade=HASH_CASCADE, shot_ids=None, skipped_starts=None
+):
+    """Computes the hamming distance between every hashed frame and each of the `max_offset` hashed frames after it
+
+    With `cascade`, each pair first goes through the cheap HASH_CASCADE_LEVELS comparisons, and the full hashes are
+    only compared for the pairs that survive them
+
+    :param hash_matrix: packed hashes, as returned by `pack_hash_bits`
+    :param max_offset: how many hashed frames ahead of each frame to compare against
+    :param cascade: whether to reject obviously different pairs early
+    :param shot_ids: shot of every frame (see `get_shot_ids`), frames of different shots aren't compared
+    :param skipped_starts: boolean mask of the frames that aren't compared with any frames after them
+
+    :return: (frames x max_offset + 1) matrix, where [i, k] is the distance between frame i and frame i + k.
+             Pairs that run past the last hashed frame, span shots, start at a skipped frame, or were rejected by the
+             cascade, are set to MAX_HASH_DIFFERENCE
+    """
+    number_of_frames = len(hash_matrix)
+
+    distances = np.full((number_of_frames, max_offset + 1), MAX_HASH_DIFFERENCE, dtype=np.int64)
+    distances[:, 0] = 0
+
+    # The pyramid is sliced out of the full hashes once, for all frames
+    pyramid = build_hash_pyramid(hash_matrix, cascade)
+
+    for offset in range(1, min(max_offset, number_of_frames - 1) + 1):
+        rows = np.arange(number_of_frames - offset)
+
+        if shot_ids is not None:
+            rows = rows[shot_ids[rows] == shot_ids[rows + offset]]
+
+        if skipped_starts is not None:
+            rows = rows[~skipped_starts[rows]]
+
+        distances[rows, offset] = pair_distances(hash_matrix, pyramid, rows, rows + offset)
+
+    return distances
+
+
+#######################################################################################################################
+
+
+def find_best_matches(
+    hash_matrix,
+    frame_numbers,
+    step_size=SEARCH_STEP_SIZE,
+    backend=SEARCH_BACKEND,
+    motion=None,
+    shot_ids=None,
+):
+    """Finds the best loop end for every start frame, all at once
+
+    For each start frame, candidates are the hashed frames between MINIMUM_LOOP_FRAMES and MAXIMUM_LOOP_FRAMES ahead
+    of it (counted in `step_size` increments). The winner is the most similar candidate whose middle frame differs
+    enough from the start frame, with ties going to the earliest candidate. Pairs rejected by the hash cascade (see
+    `hamming_distances`) are never candidates, and count as different enough when they are the middle frame. With
+    SCENE_CUTS, candidates in a different shot than the start frame aren't compared at all, and with MOTION_PREFILTER
+    neither are the start frames of static runs.
+
+    :param hash_matrix: packed hashes, one row per hashed frame
+    :param frame_numbers: sorted frame numbers of the rows of `hash_matrix`
+    :param step_size: how many frames apart the hashed frames are
+    :param backend: SEARCH_BACKEND to search with, both give the same matches
+    :param motion: motion energy of the rows of `hash_matrix`, or None to not skip static start frames
+    :param shot_ids: shots of the rows of `hash_matrix`, when they're part of a longer video that cuts were detected
+                     on. By default, they're detected on `hash_matrix`
+
+    :return: best_offsets, best_scores. The best end frame of start row i is row i + best_offsets[i], or there is none
+             if best_offsets[i] is -1
+    """
+    if backend == "pivot":
+        return find_best_matches_pivot(
+            hash_matrix, frame_numbers, step_size, motion=motion, shot_ids=shot_ids
+        )
+
+    number_of_frames = len(frame_numbers)
+    min_offset = -(-MINIMUM_LOOP_FRAMES // step_size)
+    max_offset = MAXIMUM_LOOP_FRAMES // step_size
+
+    best_offsets = np.full(number_of_frames, -1, dtype=np.int64)
+    best_scores = np.full(number_of_frames, MAX_HASH_DIFFERENCE, dtype=np.int64)
+
+    if number_of_frames == 0 or max_offset < min_offset:
+        return best_offsets, best_scores
+
+    if SCENE_CUTS and shot_ids is None:
+        shot_ids = get_shot_ids(hash_matrix)
+    elif not SCENE_CUTS:
+        shot_ids = None
+
+    skipped_starts = (
+        get_static_starts(motion, step_size) if MOTION_PREFILTER and motion is not None else None
+    )
+    distances = hamming_distances(
+        hash_matrix, max_offset, shot_ids=shot_ids, skipped_starts=skipped_starts
+    )
+
+    starts = np.arange(number_of_frames)[:, np.newaxis]
+    offsets = np.arange(min_offset, max_offset + 1)[np.newaxis, :]
+    in_range = starts + offsets < number_of_frames
+    candidates = np.minimum(starts + offsets, number_of_frames - 1)
+
+    # The middle frame is the first hashed frame at or after the midpoint, same as `FrameHashDatabase.get`
+    middle_frames = (frame_numbers[starts] + frame_numbers[candidates]) // 2
+    middle_offsets = np.searchsorted(frame_numbers, middle_frames) - starts
+
+    scores = distances[starts, offsets]
+    middle_scores = distances[starts, middle_offsets]
+
+    # A candidate is kept if it's similar enough to the start frame, and the video changes enough in between
+    passes = (
+        in_range
+        & (scores < SIMILARITY_THRESHOLD)
+        & ((middle_scores / MAX_HASH_DIFFERENCE) * 100 >= MIN_MID_FRAME_SIMILARITY)
+    )
+
+    # argmin returns the first occurrence, so ties go to the earliest candidate
+    masked_scores = np.where(passes, scores, MAX_HASH_DIFFERENCE)
+    best_columns = np.argmin(masked_scores, axis=1)
+    has_match = passes.any(axis=1)
+
+    best_offsets[has_match] = best_columns[has_match] + min_offset
+    best_scores[has_match] = masked_scores[has_match, best_columns[has_match]]
+
+    return best_offsets, best_scores
+
+
+#######################################################################################################################
+
+
+# Exact distances from every hashed frame to `number_of_pivots` pivot frames, which are picked farthest first
+def get_pivot_distances(hash_matrix, number_of_pivots=SEARCH_PIVOTS):
+
+    number_of_pivots = min(number_of_pivots, len(hash_matrix))
+    pivot_distances = np.empty((len(hash_matrix), number_of_pivots), dtype=np.int64)
+    pivot = 0
+
+    for pivot_index in range(number_of_pivots):
+        pivot_distances[:, pivot_index] = count_bits(hash_matrix ^ hash_matrix[pivot]).sum(axis=1)
+        pivot = np.argmax(pivot_distances[:, : pivot_index + 1].min(axis=1))
+
+    return pivot_distances
+
+
+#######################################################################################################################
+
+
+def find_best_matches_pivot(
+    hash_matrix,
+    frame_numbers,
+    step_size=SEARCH_STEP_SIZE,
+    number_of_pivots=SEARCH_PIVOTS,
+    motion=None,
+    shot_ids=None,
+):
+    """`find_best_matches`, skipping the comparisons that provably can't change the result
+
+    Hamming distance is a metric, so |d(a, p) - d(b, p)| <= d(a, b) for any pivot frame p. Candidates of each start
+    frame are tried in order of that lower bound (then offset), one per round for all start frames at once. A start
+    frame is done as soon as its next candidate's bound can't beat the best score it has, so the full hashes are
+    only compared for candidates that still could.
+    """
+    number_of_frames = len(frame_numbers)
+    min_offset = -(-MINIMUM_LOOP_FRAMES // step_size)
+    max_offset = MAXIMUM_LOOP_FRAMES // step_size
+
+    best_offsets = np.full(number_of_frames, -1, dtype=np.int64)
+    best_scores = np.full(number_of_frames, MAX_HASH_DIFFERENCE, dtype=np.int64)
+
+    if number_of_frames == 0 or max_offset < min_offset:
+        return best_offsets, best_scores
+
+    pyramid = build_hash_pyramid(hash_matrix)
+    pivot_distances = get_pivot_distances(hash_matrix, number_of_pivots)
+
+    starts = np.arange(number_of_frames)[:, np.newaxis]
+    offsets = np.arange(min_offset, max_offset + 1)[np.newaxis, :]
+    in_range = starts + offsets < number_of_frames
+    candidates = np.minimum(starts + offsets, number_of_frames - 1)
+
+    if SCENE_CUTS:
+        if shot_ids is None:
+            shot_ids = get_shot_ids(hash_matrix)
+
+        in_range &= shot_ids[starts] == shot_ids[candidates]
+
+    if MOTION_PREFILTER and motion is not None:
+        in_range &= ~get_static_starts(motion, step_size)[:, np.newaxis]
+
+    middle_frames = (frame_numbers[starts] + frame_numbers[candidates]) // 2
+    middle_offsets = np.searchsorted(frame_numbers, middle_frames) - starts
+
+    lower_bounds = np.zeros(candidates.shape, dtype=np.int64)
+
+    for pivot_index in range(pivot_distances.shape[1]):
+        pivot_column = pivot_distances[:, pivot_index]
+        np.maximum(
+            lower_bounds, np.abs(pivot_column[starts] - pivot_column[candidates]), out=lower_bounds
+        )
+
+    lower_bounds[~in_range] = MAX_HASH_DIFFERENCE
+
+    # A stable sort keeps candidates with equal bounds in offset order, which is how ties are broken
+    candidate_order = np.argsort(lower_bounds, axis=1, kind="stable")
+    lower_bounds = np.take_along_axis(lower_bounds, candidate_order, axis=1)
+
+    # Best (score, offset) of each start frame so far. Only scores under SIMILARITY_THRESHOLD can ever pass
+    found_scores = np.full(number_of_frames, SIMILARITY_THRESHOLD)
+    found_offsets = np.full(number_of_frames, max_offset + 1)
+
+    for candidate_rank in range(candidate_order.shape[1]):
+        round_bounds = lower_bounds[:, candidate_rank]
+        round_offsets = candidate_order[:, candidate_rank] + min_offset
+
+        could_win = (round_bounds < found_scores) | (
+            (round_bounds == found_scores) & (round_offsets < found_offsets)
+        )
+        rows = np.flatnonzero(could_win)
+
+        # Found scores only ever go down, so a start frame that's done stays done
+        if len(rows) == 0:
+            break
+
+        scores = pair_distances(hash_matrix, pyramid, rows, rows + round_offsets[rows])
+        wins = (scores < SIMILARITY_THRESHOLD) & (
+            (scores < found_scores[rows])
+            | ((scores == found_scores[rows]) & (round_offsets[rows] < found_offsets[rows]))
+        )
+        rows, scores = rows[wins], scores[wins]
+
+        # Only the winners need their middle frame checked
+        middle_rows = rows + middle_offsets[rows, round_offsets[rows] - min_offset]
+        middle_scores = pair_distances(hash_matrix, pyramid, rows, middle_rows)
+        changes_enough = (middle_scores / MAX_HASH_DIFFERENCE) * 100 >= MIN_MID_FRAME_SIMILARITY
+
+        found_scores[rows[changes_enough]] = scores[changes_enough]
+        found_offsets[rows[changes_enough]] = round_offsets[rows[changes_enough]]
+
+    has_match = found_offsets <= max_offset
+
+    best_offsets[has_match] = found_offsets[has_match]
+    best_scores[has_match] = found_scores[has_match]
+
+    return best_offsets, best_scores
+
+
+#######################################################################################################################
+
+
+# Hashes shared with the search workers, set up by `init_search_worker` in each of them
+_search_worker_state = {}
+
+
+def init_search_worker(shared_hashes, shared_frame_numbers, shared_motion, shared_shot_ids, step_size):
+    frame_numbers = np.frombuffer(shared_frame_numbers, dtype=np.int64)
+
+    _search_worker_state["hash_matrix"] = np.frombuffer(shared_hashes, dtype=np.uint64).reshape(
+        len(frame_numbers), HASH_WORDS
+    )
+    _search_worker_state["frame_numbers"] = frame_numbers
+    _search_worker_state["motion"] = (
+        np.frombuffer(shared_motion, dtype=np.float32) if shared_motion is not None else None
+    )
+    _search_worker_state["shot_ids"] = (
+        np.frombuffer(shared_shot_ids, dtype=np.int64) if shared_shot_ids is not None else None
+    )
+    _search_worker_state["step_size"] = step_size
+
+
+# Runs on a search worker: `find_best_matches` for the start frames in [first_start, end_start). Only the hashes those
+# start frames can reach are looked at, which gives the same matches as searching all of them
+def search_worker_chunk(first_start, end_start):
+
+    hash_matrix = _search_worker_state["hash_matrix"]
+    frame_numbers = _search_worker_state["frame_numbers"]
+    motion = _search_worker_state["motion"]
+    shot_ids = _search_worker_state["shot_ids"]
+    step_size = _search_worker_state["step_size"]
+
+    rows = min(end_start + MAXIMUM_LOOP_FRAMES // step_size, len(frame_numbers))
+    best_offsets, best_scores = find_best_matches(
+        hash_matrix[first_start:rows],
+        frame_numbers[first_start:rows],
+        step_size,
+        motion=motion[first_start:rows] if motion is not None else None,
+        shot_ids=shot_ids[first_start:rows] if shot_ids is not None else None,
+    )
+
+    return best_offsets[: end_start - first_start], best_scores[: end_start - first_start]
+
+
+#######################################################################################################################
+
+
+def find_best_matches_parallel(
+    hash_matrix,
+    frame_numbers,
+    step_size=SEARCH_STEP_SIZE,
+    workers=SEARCH_WORKERS,
+    chunk_size=SEARCH_WORKER_CHUNK_SIZE,
+    motion=None,
+):
+    """`find_best_matches` split over a pool of `workers` processes, `chunk_size` start frames at a time
+
+    The packed hashes are copied into shared memory once, so the workers read them in place instead of getting them
+    pickled with every chunk. Chunk results are put back together in start frame order, so the output is exactly
+    the same as that of `find_best_matches`
+    """
+    number_of_frames = len(frame_numbers)
+
+    shared_hashes = RawArray(c_uint64, number_of_frames * HASH_WORDS)
+    np.frombuffer(shared_hashes, dtype=np.uint64)[:] = hash_matrix.reshape(-1)
+    shared_frame_numbers = RawArray(c_int64, number_of_frames)
+    np.frombuffer(shared_frame_numbers, dtype=np.int64)[:] = frame_numbers
+    shared_motion = None
+
+    if motion is not None:
+        shared_motion = RawArray(c_float, number_of_frames)
+        np.frombuffer(shared_motion, dtype=np.float32)[:] = motion
+
+    # Cuts are detected on the whole video, like the serial search does
+    shared_shot_ids = None
+
+    if SCENE_CUTS:
+        shared_shot_ids = RawArray(c_int64, number_of_frames)
+        np.frombuffer(shared_shot_ids, dtype=np.int64)[:] = get_shot_ids(hash_matrix)
+
+    chunks = [
+        (first_start, min(first_start + chunk_size, number_of_frames))
+        for first_start in range(0, number_of_frames, chunk_size)
+    ]
+
+    with multiprocessing.Pool(
+        workers,
+        initializer=init_search_worker,
+        initargs=(shared_hashes, shared_frame_numbers, shared_motion, shared_shot_ids, step_size),
+    ) as search_pool:
+        chunk_results = search_pool.starmap(search_worker_chunk, chunks)
+
+    return (
+        np.concatenate([best_offsets for best_offsets, _ in chunk_results]),
+        np.concatenate([best_scores for _, best_scores in chunk_results]),
+    )
+
+
+#######################################################################################################################
+
+
+# `find_best_matches` for the first `number_of_starts` rows of a window of hashes that's long enough for all of their
+# candidates, as CandidateLoops in start frame order. Runs on a search worker for `IncrementalLoopSearch`
+def search_chunk(hash_matrix, frame_numbers, step_size, motion, shot_ids, number_of_starts, frame_rate):
+
+    best_offsets, best_scores = find_best_matches(
+        hash_matrix, frame_numbers, step_size, motion=motion, shot_ids=shot_ids
+    )
+
+    return collect_candidates(
+        best_offsets[:number_of_starts], best_scores[:number_of_starts], frame_numbers, frame_rate
+    )
+
+
+#######################################################################################################################
+
+
+# Turn the results of `find_best_matches` into CandidateLoops, in start frame order
+def collect_candidates(best_offsets, best_scores, frame_numbers, frame_rate):
+
+    candidates = []
+
+    for start_index in np.flatnonzero(best_offsets >= 0):
+        end_index = start_index + best_offsets[start_index]
+        new_candidate = CandidateLoop(
+            float(best_scores[start_index]),
+            int(frame_numbers[start_index]),
+            int(frame_numbers[end_index]),
+            frame_rate,
+        )
+        candidates.append(new_candidate)
+
+    return candidates
+
+
+#######################################################################################################################
+
+
+# Main program loop. As the name suggests, we use this to evaluate every start frame vs its candidates. The whole
+# search runs on the packed hashes in bulk, see `find_best_matches`
+def search_for_loops(hash_db, frame_rate, callback, workers=SEARCH_WORKERS):
+
+    callback("Searching for loops...", 60)
+
+    frame_numbers = hash_db.frame_numbers
+
+    # Worker processes only pay off once there's more than a chunk of start frames for each of them
+    if workers > 1 and len(frame_numbers) > SEARCH_WORKER_CHUNK_SIZE:
+        best_offsets, best_scores = find_best_matches_parallel(
+            hash_db.hashes, frame_numbers, hash_db.step_size, workers, motion=hash_db.motion
+        )
+    else:
+        best_offsets, best_scores = find_best_matches(
+            hash_db.hashes, frame_numbers, hash_db.step_size, motion=hash_db.motion
+        )
+
+    # Store information corresponding to top loop candidates
+    best_webm_candidates = collect_candidates(
+        best_offsets, best_scores, frame_numbers, frame_rate
+    )
+
+    callback("Searching for loops...", 80)
+
+    # Sort the candidates by score, best (lowest hamming distance) first
+    best_webm_candidates.sort(key=lambda x: x.score)
+
+    return best_webm_candidates
+
+
+#######################################################################################################################
+
+
+def phash_batch(gray_frames):
+    """Vectorized `imagehash.phash` over a batch of HASH_INPUT_SIZE x HASH_INPUT_SIZE grayscale frames
+
+    Runs the same scipy DCTs as imagehash, only along the batch axis, so the hashes are bit-identical. The second
+    DCT only runs on the low frequency rows that end up in the hash.
+
+    :param gray_frames: (frames x HASH_INPUT_SIZE x HASH_INPUT_SIZE) uint8 array
+
+    :return: (frames x HASH_SIZE x HASH_SIZE) boolean array
+    """
+    dct_rows = scipy.fftpack.dct(gray_frames, axis=1)[:, :HASH_SIZE, :]
+    dct_low_frequency = scipy.fftpack.dct(dct_rows, axis=2)[:, :, :HASH_SIZE]
+
+    medians = np.median(dct_low_frequency, axis=(1, 2))
+
+    return dct_low_frequency > medians[:, np.newaxis, np.newaxis]
+
+
+#######################################################################################################################
+
 
-    callback("Stabilizing video...", stabilize_progress)
+def read_frame_batches(
+    video_path, frame_rate, buffer_pool, start_frame, end_frame, step_size=SEARCH_STEP_SIZE
+):
+    """Yields (frame_numbers, frames) batches of every `step_size`th frame in [start_frame, end_frame), by FRAME_READER
 
-    for command in (calculate_vector_command, stabilize_command):
+    The first len(frame_numbers) frames of each buffer are filled. Buffers come from `buffer_pool`, and it's up to the
+    consumer to release them
+    """
+    if FRAME_READER == "ffmpeg":
+        yield from FFmpegFrameReader(
+            video_path, frame_rate, buffer_pool, step_size, start_frame, end_frame
+        )
+        return
 
-        callback("Stabilizing video...", stabilize_progress)
+    frame_batch = GrayFrameBatch(buffer_pool)
 
-        # run the command
-        subprocess.run(command)
+    for frame_number, frame in SampledFrameReader(
+        video_path, step_size, start_frame, end_frame
+    ):
+        frame_batch.add(frame_number, frame)
 
-        stabilize_progress += 10
+        if frame_batch.is_full():
+            yield frame_batch.flush()
+
+    if len(frame_batch):
+        yield frame_batch.flush()
 
 
 #######################################################################################################################
 
 
-# We'll use this to tell FFMPEG what kind of GIF/WEBM we want, i.e., give it correctly formatted parameters
-def prepare_webm_info(
-    candidate, webm_destination_folder, stable_video_path, sound_enabled, counter
-):
+# Runs on the decoder thread: pushes decoded batches to the hashing side, followed by None (or the exception that
+# stopped decoding)
+def decode_frame_batches(batch_queue, *read_frame_batches_args):
+    try:
+        for frame_batch in read_frame_batches(*read_frame_batches_args):
+            batch_queue.put(frame_batch)
+    except FrameBufferPool.Closed:
+        return
+    except Exception as e:
+        batch_queue.put(e)
+        return
 
-    webm_name = "{}.webm".format(counter)
-    webm_destination = os.path.join(webm_destination_folder, webm_name)
-    webm_encode_command = [
-        "ffmpeg",
-        "-y",
-        "-ss",
-        str(candidate.start_time),
-        "-t",
-        str(candidate.duration),
-        "-i",
-        stable_video_path,
-    ]
+    batch_queue.put(None)
 
-    if not sound_enabled:
-        webm_encode_command.append("-an")
 
-    # This part of command will then process all frames in temp directory to output to GIF/WEBM
-    webm_encode_command.extend(
-        [
-            "-minrate",
-            "1700k",
-            "-b:v",
-            "1800K",
-            "-maxrate",
-            "2000K",
-            "-c:v",
-            "libvpx",
-            "-vf",
-            "scale=500:-2",
-            webm_destination,
-        ]
+#######################################################################################################################
+
+
+# Block averages of grayscale frames, which motion energy is measured on
+def motion_thumbnails(gray_frames):
+
+    block_size = HASH_INPUT_SIZE // MOTION_THUMBNAIL_SIZE
+    blocks = gray_frames.reshape(
+        len(gray_frames), MOTION_THUMBNAIL_SIZE, block_size, MOTION_THUMBNAIL_SIZE, block_size
     )
 
-    candidate.webm_encode_command = webm_encode_command
-    candidate.webm_name = webm_name
+    return blocks.mean(axis=(2, 4), dtype=np.float32)
 
-    return candidate
+
+#######################################################################################################################
+
+
+# Runs on a hashing worker: hashes & packs a decoded batch, takes its motion thumbnails, and returns its buffer to
+# the pool
+def hash_frame_batch(buffer_pool, frame_numbers, frames):
+    try:
+        hashes = pack_hash_bits(phash_batch(frames[: len(frame_numbers)]))
+        thumbnails = motion_thumbnails(frames[: len(frame_numbers)])
+    finally:
+        buffer_pool.release(frames)
+
+    return np.asarray(frame_numbers, dtype=np.int64), hashes, thumbnails
 
 
 #######################################################################################################################
 
 
-def prepare_gif_info(
-    candidate, webm_destination_folder, stable_video_path, frame_directory_path, counter
-):
+def compute_frame_hashes(video_path, frame_rate, start_frame, end_frame, step_size):
+    """Decodes & hashes every `step_size`th frame in [start_frame, end_frame), yielding (frame_numbers, packed hashes,
+    motion) batches in frame order
 
-    gif_name = "{}.gif".format(counter)
-    gif_destination = os.path.join(webm_destination_folder, gif_name)
-    palette_destination = os.path.join(frame_directory_path, "palette.png")
+    Decoding runs on its own thread and fills a bounded pool of batch buffers, which HASH_WORKERS threads hash
+    as they come in. Batches are yielded on the calling thread, which also works out their motion energy. The
+    hashed frame before the interval is decoded too, so that the motion of the first one doesn't depend on where the
+    interval starts. Only the very first frame of the video has no motion energy (NaN)
+    """
+    frames_to_hash = max(end_frame - start_frame, 1)
+    first_sample = -(-start_frame // step_size) * step_size
+    read_start = max(first_sample - step_size, 0)
+    previous_thumbnail = None
 
-    gif_palette_command = [
-        "ffmpeg",
-        "-y",
-        "-ss",
-        str(candidate.start_time),
-        "-t",
-        str(candidate.duration),
-        "-i",
-        stable_video_path,
-        "-vf",
-        "scale=500:-2:flags=lanczos,palettegen",
-        palette_destination,
-    ]
+    def hashed_batch(hash_future):
+        nonlocal previous_thumbnail
 
-    gif_encode_command = [
-        "ffmpeg",
-        "-y",
-        "-ss",
-        str(candidate.start_time),
-        "-t",
-        str(candidate.duration),
-        "-i",
-        stable_video_path,
-        "-i",
-        palette_destination,
-        "-filter_complex",
-        "fps=25,scale=500:-2:flags=lanczos[x];[x][1:v]paletteuse",
-        gif_destination,
-    ]
+        frame_numbers, hashes, thumbnails = hash_future.result()
 
-    candidate.gif_palette_command = gif_palette_command
-    candidate.gif_encode_command = gif_encode_command
-    candidate.gif_name = gif_name
+        hash_progress = (frame_numbers[-1] - start_frame) * 100 / frames_to_hash
+        logger.info(f"Hash Progress: {hash_progress}%")
 
-    return candidate
+        # Motion energy of each frame is measured against the one hashed before it
+        if previous_thumbnail is None:
+            previous_thumbnail = np.full_like(thumbnails[0], np.nan)
 
+        all_thumbnails = np.concatenate([previous_thumbnail[np.newaxis], thumbnails])
+        motion = np.abs(np.diff(all_thumbnails, axis=0)).mean(axis=(1, 2))
+        previous_thumbnail = thumbnails[-1]
 
-#######################################################################################################################
+        # Leave out the frame before the interval
+        in_interval = frame_numbers >= first_sample
 
+        return frame_numbers[in_interval], hashes[in_interval], motion[in_interval]
 
-def prepare_mp4_info(
-    candidate, webm_destination_folder, stable_video_path, sound_enabled, counter
-):
+    buffer_pool = FrameBufferPool(HASH_PIPELINE_BATCHES)
+    batch_queue = queue.Queue()
 
-    mp4_name = "{}.mp4".format(counter)
-    mp4_destination = os.path.join(webm_destination_folder, mp4_name)
+    decoder_thread = threading.Thread(
+        target=decode_frame_batches,
+        args=(
+            batch_queue,
+            video_path,
+            frame_rate,
+            buffer_pool,
+            read_start,
+            end_frame,
+            step_size,
+        ),
+        daemon=True,
+    )
+    decoder_thread.start()
 
-    mp4_encode_command = [
-        "ffmpeg",
-        "-y",
-        "-ss",
-        str(candidate.start_time),
-        "-t",
-        str(candidate.duration),
-        "-i",
-        stable_video_path,
-        "-an",
-        "-b:v",
-        "1800K",
-        "-c:v",
-        "libx264",
-        "-vf",
-        "scale=500:-2",
-        mp4_destination,
-    ]
+    try:
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as hash_pool:
+            hash_futures = deque()
 
-    if sound_enabled:
-        mp4_encode_command.remove("-an")
+            while True:
+                frame_batch = batch_queue.get()
 
-    candidate.mp4_encode_command = mp4_encode_command
-    candidate.mp4_name = mp4_name
+                if frame_batch is None:
+                    break
+                elif isinstance(frame_batch, Exception):
+                    raise frame_batch
 
-    return candidate
+                hash_futures.append(
+                    hash_pool.submit(hash_frame_batch, buffer_pool, *frame_batch)
+                )
 
+                # Keep hashes in frame order, only handing out batches once everything before them is done
+                while hash_futures and hash_futures[0].done():
+                    hash_batch = hashed_batch(hash_futures.popleft())
 
-#######################################################################################################################
+                    if len(hash_batch[0]):
+                        yield hash_batch
 
+            while hash_futures:
+                hash_batch = hashed_batch(hash_futures.popleft())
 
-# We'll clean/populate the temp directory and then create the loops from list of sorted candidates
-def create_candidate_loops(best_webm_candidates, callback):
+                if len(hash_batch[0]):
+                    yield hash_batch
+    finally:
+        # Unblocks the decoder if we're bailing out early
+        buffer_pool.close()
+        decoder_thread.join()
 
-    percent_per_webm = 20 / NUMBER_WEBMS_TO_MAKE
-    encode_progress = 80
 
-    callback("Encoding webms...", encode_progress)
+#######################################################################################################################
 
-    for i in range(0, min(len(best_webm_candidates), NUMBER_WEBMS_TO_MAKE)):
 
-        gif_palette_command = best_webm_candidates[i].gif_palette_command
-        gif_encode_command = best_webm_candidates[i].gif_encode_command
-        webm_encode_command = best_webm_candidates[i].webm_encode_command
-        mp4_encode_command = best_webm_candidates[i].mp4_encode_command
+# Like `compute_frame_hashes`, but only for the frames that aren't in `hash_cache` yet, which then get added to it.
+# Cached frames are read back from it. The cache counts frames of the source video, which are `frame_offset` frames
+# ahead of the ones of `video_path` when that's only a window of the source, like the analysis proxy
+def cached_frame_hashes(
+    hash_cache, video_path, frame_rate, start_frame, end_frame, step_size, frame_offset=0
+):
+
+    # The frames sampled in the window have to be the ones the cache samples
+    if frame_offset % step_size:
+        raise ValueError(f"Frame offset {frame_offset} isn't a multiple of the step size {step_size}")
+
+    for run_start, run_end, is_cached in hash_cache.runs(
+        start_frame + frame_offset, end_frame + frame_offset
+    ):
+        if is_cached:
+            logger.info(f"Hashes of frames {run_start} to {run_end} are cached")
 
-        for command in (
-            gif_palette_command,
-            gif_encode_command,
-            webm_encode_command,
-            mp4_encode_command,
+            for frame_numbers, hashes, motion in hash_cache.read(run_start, run_end):
+                yield frame_numbers - frame_offset, hashes, motion
+            continue
+
+        # The first frame of a window has no motion energy, which only means it never counts as static
+        for frame_numbers, hashes, motion in compute_frame_hashes(
+            video_path, frame_rate, run_start - frame_offset, run_end - frame_offset, step_size
         ):
-            subprocess.run(command)
+            hash_cache.store(frame_numbers + frame_offset, hashes, motion)
+            yield frame_numbers, hashes, motion
 
-        encode_progress = encode_progress + percent_per_webm
 
-        callback("Encoding webms...", encode_progress)
+# Close a FrameHashCache the job is done with, and make room in the cache for the next jobs
+def close_frame_hash_cache(hash_cache):
+    hash_cache.close()
+    evict_hash_cache(keep=hash_cache.entry_path)
 
 
 #######################################################################################################################
 
 
-def compare_candidates(
-    start_frame, candidate_frame, hash_db, best_score_this_iteration
+def iter_frame_hashes(
+    stable_video_path,
+    frame_rate,
+    callback,
+    start_frame=0,
+    end_frame=None,
+    step_size=SEARCH_STEP_SIZE,
+    use_cache=HASH_CACHE,
+    hash_cache=None,
+    frame_offset=0,
 ):
+    """Hashes video frames using perceptual hashing, yielding (frame_numbers, packed hashes, motion) batches in frame
+    order
 
-    start_hash = hash_db.get(start_frame)
-    candidate_hash = hash_db.get(candidate_frame)
+    With `use_cache`, frames already in the FrameHashCache of the video are read from it, and only the missing ones
+    are decoded & hashed, see `compute_frame_hashes`. The calling thread is the only one to call `callback`
 
-    current_candidate_similarity = start_hash - candidate_hash
-    current_candidate_similarity = float(current_candidate_similarity)
-
-    # Keep track of which of the candidates get the best score when compared to start frame
-    if (
-        current_candidate_similarity < SIMILARITY_THRESHOLD
-        and current_candidate_similarity < best_score_this_iteration
-    ):
+    :param stable_video_path: where the stabilized video is located
+    :param frame_rate: frame rate of the video
+    :param callback: a callback function
+    :param start_frame: first frame of the interval to hash
+    :param end_frame: frame the interval ends before, or None to hash until the end of the video
+    :param step_size: only every `step_size`th frame is hashed
+    :param use_cache: whether to go through the hash cache
+    :param hash_cache: open FrameHashCache to go through instead of the video's own, e.g. the source video's
+    :param frame_offset: how far the frames of `hash_cache` are ahead of the ones of the video
+    """
+    callback("Preparing to search...", 40)
 
-        middle_frame = (start_frame + candidate_frame) // 2
-        middle_frame_hash = hash_db.get(middle_frame)
+    number_of_frames = probe(stable_video_path).frame_count
 
-        start_middle_percent_diff = (
-            (start_hash - middle_frame_hash) / MAX_HASH_DIFFERENCE
-        ) * 100
-        if start_middle_percent_diff < MIN_MID_FRAME_SIMILARITY:
-            return None
+    if end_frame is None:
+        end_frame = number_of_frames
 
-        best_score_this_iteration = current_candidate_similarity
+    if hash_cache is not None:
+        yield from cached_frame_hashes(
+            hash_cache, stable_video_path, frame_rate, start_frame, end_frame, step_size, frame_offset
+        )
+    elif use_cache:
+        hash_cache = FrameHashCache(stable_video_path, step_size, max(number_of_frames, end_frame))
 
-        return best_score_this_iteration, start_frame, candidate_frame
+        try:
+            yield from cached_frame_hashes(
+                hash_cache, stable_video_path, frame_rate, start_frame, end_frame, step_size
+            )
+        finally:
+            close_frame_hash_cache(hash_cache)
+    else:
+        yield from compute_frame_hashes(
+            stable_video_path, frame_rate, start_frame, end_frame, step_size
+        )
 
-    return None
+    callback("Preparing to search...", 60)
 
 
 #######################################################################################################################
 
 
-def add_info_to_candidates(
-    best_webm_candidates,
-    webm_destination_folder,
+def hash_frames(
     stable_video_path,
-    frame_directory_path,
-    sound_enabled,
+    frame_rate,
+    callback,
+    start_frame=0,
+    end_frame=None,
+    step_size=SEARCH_STEP_SIZE,
+    hash_cache=None,
+    frame_offset=0,
 ):
+    """Hashes video frames using perceptual hashing
 
-    for counter, candidate in enumerate(best_webm_candidates, 1):
+    :param stable_video_path: where the stabilized video is located
+    :param frame_rate: frame rate of the video
+    :param callback: a callback function
+    :param start_frame: first frame of the interval to hash
+    :param end_frame: frame the interval ends before, or None to hash until the end of the video
+    :param step_size: only every `step_size`th frame is hashed
+    :param hash_cache: open FrameHashCache to go through, see `iter_frame_hashes`
+    :param frame_offset: how far the frames of `hash_cache` are ahead of the ones of the video
 
-        prepare_webm_info(
-            candidate,
-            webm_destination_folder,
-            stable_video_path,
-            sound_enabled,
-            counter,
-        )
-        prepare_gif_info(
-            candidate,
-            webm_destination_folder,
-            stable_video_path,
-            frame_directory_path,
-            counter,
-        )
-        prepare_mp4_info(
-            candidate,
-            webm_destination_folder,
+    :return: FrameHashDatabase of the hashed frames
+    """
+    return FrameHashDatabase.from_batches(
+        iter_frame_hashes(
             stable_video_path,
-            sound_enabled,
-            counter,
-        )
-
-    return best_webm_candidates
+            frame_rate,
+            callback,
+            start_frame,
+            end_frame,
+            step_size,
+            hash_cache=hash_cache,
+            frame_offset=frame_offset,
+        ),
+        step_size,
+        stable_video_path,
+    )
 
 
 #######################################################################################################################
 
 
-# Main program loop. As the name suggests, we use this to go through each frame and evaluate
-# start frames vs candidates
-def search_for_loops(hashed_frames_list, hash_db, frame_rate, callback):
+# Long intervals are searched at a coarser step, their loops get refined to single frame precision afterwards anyway
+def get_search_step_size(start_frame, end_frame):
+    if end_frame - start_frame >= COARSE_SEARCH_MIN_FRAMES:
+        return COARSE_SEARCH_STEP_SIZE
 
-    iteration = 0  # What iteration of the search process we're on
-    best_webm_candidates = (
-        []
-    )  # Store commands & information corresponding to top loop candidates
+    return SEARCH_STEP_SIZE
 
-    callback("Searching for loops...", 60)
 
-    # Loop through every hash, comparing start hashes to candidates hashes
-    for start_frame in hashed_frames_list:
-        best_candidate = None
-        iteration = iteration + 1
-        candidate_counter = (
-            0
-        )  # Limits min & max number of candidates to compare to 1st frame in window
-
-        # Move candidate search window & initialize highest similarity score to 0
-        # Highest similarity refers to best candidate frame in current window
-        candidate_frames = hashed_frames_list[iteration:]
-        best_score_this_iteration = MAX_HASH_DIFFERENCE
-
-        # Loop though every candidate frame and compare to start frame
-        for candidate_frame in candidate_frames:
-            candidate_counter = candidate_counter + SEARCH_STEP_SIZE
-
-            if candidate_counter < MINIMUM_LOOP_FRAMES:
-                continue
-            elif candidate_counter > MAXIMUM_LOOP_FRAMES:
-                break
-            else:
-                candidate = compare_candidates(
-                    start_frame, candidate_frame, hash_db, best_score_this_iteration
-                )
-                if candidate is not None:
-                    best_candidate = candidate
-                    best_score_this_iteration, _, _ = candidate
-
-        # If we've found a loop after comparing all the candidates, we can create it
-        if best_candidate is not None:
-            best_score_this_iteration, start_frame_number, end_frame_number = (
-                best_candidate
-            )
-            new_candidate = CandidateLoop(
-                best_score_this_iteration,
-                start_frame_number,
-                end_frame_number,
-                frame_rate,
-            )
-            # Append the candidate loop along with its score, start, end, & framerate
-            best_webm_candidates.append(new_candidate)
+#######################################################################################################################
 
-    callback("Searching for loops...", 80)
 
-    # Since best_webm_candidates is a list of lists... aka... [ [0.89, commandString], [0.91, commandString] ]
-    # Sort the outer list based on first item (score) of each inner list, highest to lowest score
-    best_webm_candidates.sort(key=lambda x: x.score)
+def hash_frame_range(video_path, frame_rate, start_frame, end_frame):
+    """Hashes every frame in [start_frame, end_frame), on the calling thread
 
-    return best_webm_candidates
+    :return: frame_numbers, packed hashes
+    """
+    buffer_pool = FrameBufferPool(1)
+    frame_numbers = []
+    packed_hashes = []
+
+    for frame_batch in read_frame_batches(
+        video_path, frame_rate, buffer_pool, start_frame, end_frame, step_size=1
+    ):
+        batch_frame_numbers, hashes, _ = hash_frame_batch(buffer_pool, *frame_batch)
+
+        frame_numbers.extend(batch_frame_numbers)
+        packed_hashes.append(hashes)
+
+    if not packed_hashes:
+        return np.empty(0, dtype=np.int64), np.empty((0, HASH_WORDS), dtype=np.uint64)
+
+    return np.asarray(frame_numbers, dtype=np.int64), np.concatenate(packed_hashes)
 
 
 #######################################################################################################################
 
 
-def hash_frames(stable_video_path, callback):
-    """Hashes video frames using perceptual hashing
+def refine_candidate(video_path, candidate, step_size, start_frame, end_frame):
+    """Moves the start & end of a loop found at `step_size` granularity to the best frames within a step of them
 
-    :param stable_video_path: where the stabilized video is located
-    :param callback: a callback function
+    Only the frames around the start, the end and the middle of the loop are decoded & hashed. The refined loop has
+    to pass the same checks as in `find_best_matches`, and only replaces the candidate if it scores strictly better.
 
-    :return: hash_dictionary, hashed_frames_list
+    :param video_path: the video that was searched
+    :param candidate: CandidateLoop from the coarse search
+    :param step_size: step the coarse search ran at
+    :param start_frame: first frame of the searched interval
+    :param end_frame: frame the searched interval ends before
+
+    :return: the refined CandidateLoop, or `candidate` if nothing better was found
     """
-    callback("Preparing to search...", 40)
+    radius = step_size - 1
 
-    hashed_frames_list = []
-    hash_dictionary = {}
+    if radius <= 0:
+        return candidate
 
-    current_frame = 0
+    def frames_around(frame_number):
+        return max(frame_number - radius, start_frame), min(frame_number + radius + 1, end_frame)
 
-    video_capture = cv2.VideoCapture(stable_video_path)
-    number_of_frames = video_capture.get(cv2.CAP_PROP_FRAME_COUNT)
+    frame_rate = candidate.frame_rate
+    start_numbers, start_hashes = hash_frame_range(
+        video_path, frame_rate, *frames_around(candidate.start_frame_number)
+    )
+    end_numbers, end_hashes = hash_frame_range(
+        video_path, frame_rate, *frames_around(candidate.end_frame_number)
+    )
 
-    while video_capture.isOpened:
+    if len(start_numbers) == 0 or len(end_numbers) == 0:
+        logger.warning(f"No frames around loop {candidate.start_frame_number} of {video_path}, not refining it")
+        return candidate
 
-        # Extract the frame
-        ret, frame = video_capture.read()
+    loop_starts = start_numbers[:, np.newaxis]
+    loop_ends = end_numbers[np.newaxis, :]
+    loop_lengths = loop_ends - loop_starts
+    middle_frames = (loop_starts + loop_ends) // 2
 
-        if not ret:
-            video_capture.release()
-            break
+    middle_numbers, middle_hashes = hash_frame_range(
+        video_path, frame_rate, middle_frames.min(), middle_frames.max() + 1
+    )
 
-        if current_frame % 150 == 0:
-            logger.info(f"Hash Progress: {(current_frame * 100) / number_of_frames}%")
+    if len(middle_numbers) == 0:
+        logger.warning(f"No frames within loop {candidate.start_frame_number} of {video_path}, not refining it")
+        return candidate
 
-        if current_frame % SEARCH_STEP_SIZE == 0:
-            cv2_image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            pillow_image = Image.fromarray(cv2_image)
-            perceptual_hash = imagehash.phash(pillow_image, hash_size=HASH_SIZE)
-            hashed_frames_list.append(current_frame)
-            hash_dictionary[current_frame] = perceptual_hash
+    middle_indexes = np.minimum(
+        np.searchsorted(middle_numbers, middle_frames), len(middle_numbers) - 1
+    )
 
-        current_frame += 1
+    scores = count_bits(start_hashes[:, np.newaxis, :] ^ end_hashes[np.newaxis, :, :]).sum(axis=2)
+    middle_scores = count_bits(
+        start_hashes[:, np.newaxis, :] ^ middle_hashes[middle_indexes]
+    ).sum(axis=2)
 
-    callback("Preparing to search...", 60)
+    passes = (
+        (loop_lengths >= MINIMUM_LOOP_FRAMES)
+        & (loop_lengths <= MAXIMUM_LOOP_FRAMES)
+        & (scores < SIMILARITY_THRESHOLD)
+        & ((middle_scores / MAX_HASH_DIFFERENCE) * 100 >= MIN_MID_FRAME_SIMILARITY)
+    )
+    masked_scores = np.where(passes, scores, MAX_HASH_DIFFERENCE)
+    best_start, best_end = np.unravel_index(np.argmin(masked_scores), masked_scores.shape)
+
+    if masked_scores[best_start, best_end] >= candidate.score:
+        return candidate
 
-    return hash_dictionary, hashed_frames_list
+    return CandidateLoop(
+        float(masked_scores[best_start, best_end]),
+        int(start_numbers[best_start]),
+        int(end_numbers[best_end]),
+        frame_rate,
+    )
+
+
+# Refine every loop, see `refine_candidate`. Refining can change the scores, so the loops get sorted again, best first
+def refine_candidates(video_path, candidates, step_size, start_frame, end_frame):
+    refined_candidates = [
+        refine_candidate(video_path, candidate, step_size, start_frame, end_frame) for candidate in candidates
+    ]
+
+    # Scores are hamming distances, the lower the better
+    refined_candidates.sort(key=lambda candidate: candidate.score)
+
+    return refined_candidates
 
 
 #######################################################################################################################
@@ -694,6 +2929,17 @@ def get_video_info_tuple(best_webm_candidates, webm_destination_folder):
 #######################################################################################################################
 
 
+# Convert the start & end timestamps into the [start_frame, end_frame) interval of frames we search through
+def get_frame_interval(start_time, end_time, frame_rate):
+    start_frame = int(round(start_time * frame_rate))
+    end_frame = int(round(end_time * frame_rate))
+
+    return start_frame, end_frame
+
+
+#######################################################################################################################
+
+
 # Check if the params we've been given for start & end are valid
 def check_valid_interval(start_time, end_time, duration):
     if start_time < 0 or end_time < 0:
@@ -712,7 +2958,12 @@ def check_valid_interval(start_time, end_time, duration):
 
 
 def make_loops(
-    path_of_source_video, start_time=0, end_time=20, callback=None, sound_enabled=True
+    path_of_source_video,
+    start_time=0,
+    end_time=20,
+    callback=None,
+    sound_enabled=True,
+    stabilize=False,
 ):
     # avoid repetitive callback checks and simply use this function
     def safe_callback(status, progress):
@@ -735,7 +2986,8 @@ def make_loops(
 
     start_time = float(start_time)
     end_time = float(end_time)
-    duration = get_duration(path_of_source_video)
+    media_info = probe(path_of_source_video)
+    duration = media_info.duration
 
     if not check_valid_interval(start_time, end_time, duration):
         raise InvalidIntervalException()
@@ -746,32 +2998,220 @@ def make_loops(
     )
 
     # Get the frame rate so that we can then use it to calculate the number of frames
-    frame_rate = get_frame_rate(path_of_source_video)
+    frame_rate = float(media_info.frame_rate)
 
-    # Calculate the hashes we're going to iterate through
-    hash_dictionary, hashed_frames_list = hash_frames(
-        path_of_source_video, safe_callback
-    )
+    # Only the frames between the start & end timestamps get hashed, and therefore searched
+    start_frame, end_frame = get_frame_interval(start_time, end_time, frame_rate)
 
-    hash_db = FrameHashDatabase(hash_dictionary, path_of_source_video)
+    # The end timestamp can be past the last frame, which is never hashed, or cached
+    if media_info.frame_count:
+        end_frame = min(end_frame, media_info.frame_count)
 
-    # Start searching the entire list of frames for loops, then add ffmpeg commands for each candidate
-    best_webm_candidates = search_for_loops(
-        hashed_frames_list, hash_db, frame_rate, safe_callback
-    )
+    step_size = get_search_step_size(start_frame, end_frame)
+
+    # Stabilization & the analysis proxy cover a window starting on a sampled frame, so that the frames sampled in it
+    # line up with the ones in the hash cache
+    window_start_frame = start_frame - start_frame % step_size
+
+    # The video that gets searched. When it's only the window, like the stabilized video or the analysis proxy, its
+    # frame numbers are `frame_offset` frames behind the ones of the source video
+    search_video_path = path_of_source_video
+    frame_offset = 0
+
+    if stabilize:
+        stable_video_path = os.path.join(source_video_folder, STABLE_VIDEO_NAME)
+        stable_start_time = stabilize_video(
+            path_of_source_video,
+            stable_video_path,
+            window_start_frame,
+            end_frame,
+            frame_rate,
+            sound_enabled,
+            safe_callback,
+        )
+
+        search_video_path = stable_video_path
+        frame_offset = window_start_frame
+
+    # Hashes are cached under the source video & its frame numbers, whichever video they're read from
+    hash_cache = None
+
+    if HASH_CACHE:
+        hashed_video = "proxy" if ANALYSIS_PROXY else "source"
+
+        if stabilize:
+            hashed_video += f":stable:{window_start_frame}:{end_frame}:{LOOP_WIDTH}:{STABILIZE_DETECT_OPTIONS}"
+
+        hash_cache = FrameHashCache(
+            path_of_source_video,
+            step_size,
+            max(media_info.frame_count, end_frame),
+            variant=hashed_video,
+        )
+
+    try:
+        if ANALYSIS_PROXY and hash_cache is not None:
+            search_video_path, frame_offset = cached_analysis_proxy(
+                hash_cache.entry_path,
+                search_video_path,
+                frame_offset,
+                window_start_frame,
+                end_frame,
+                frame_rate,
+                safe_callback,
+            )
+        elif ANALYSIS_PROXY:
+            # Removed along with the frames folder
+            search_video_path = make_analysis_proxy(
+                search_video_path,
+                os.path.join(frame_directory_path, "analysis_proxy.mkv"),
+                window_start_frame - frame_offset,
+                end_frame - frame_offset,
+                frame_rate,
+                safe_callback,
+            )
+            frame_offset = window_start_frame
+
+        # The searched interval in frames of the searched video
+        search_start_frame = start_frame - frame_offset
+        search_end_frame = end_frame - frame_offset
+
+        if STREAMING_SEARCH:
+            # Search for loops as the hashes come in, so that searching overlaps with decoding. Worker processes only
+            # pay off once there's more than a chunk of start frames to hand each of them
+            search_workers = SEARCH_WORKERS
+
+            if (search_end_frame - search_start_frame) // step_size <= SEARCH_CHUNK_SIZE * SEARCH_WORKERS:
+                search_workers = 1
+
+            loop_search = IncrementalLoopSearch(frame_rate, step_size=step_size, workers=search_workers)
+
+            try:
+                for hash_batch in iter_frame_hashes(
+                    search_video_path,
+                    frame_rate,
+                    safe_callback,
+                    search_start_frame,
+                    search_end_frame,
+                    step_size,
+                    hash_cache=hash_cache,
+                    frame_offset=frame_offset,
+                ):
+                    loop_search.add(*hash_batch)
+
+                best_webm_candidates = loop_search.finish()
+            finally:
+                loop_search.close()
+            safe_callback("Searching for loops...", 80)
+        else:
+            # Calculate the hashes we're going to iterate through
+            hash_db = hash_frames(
+                search_video_path,
+                frame_rate,
+                safe_callback,
+                search_start_frame,
+                search_end_frame,
+                step_size,
+                hash_cache=hash_cache,
+                frame_offset=frame_offset,
+            )
+
+            # Start searching the entire list of frames for loops
+            loop_candidates = search_for_loops(hash_db, frame_rate, safe_callback)
+
+            # Only keep the best loops that aren't just shifted copies of each other
+            candidate_selector = CandidateSelector()
+
+            for candidate in loop_candidates:
+                candidate_selector.push(candidate)
+
+            best_webm_candidates = candidate_selector.select()
+
+        # The search only looked at every `step_size`th frame, so pin down the exact loop boundaries. The searched
+        # video can be a proxy in the hash cache entry, which stays in use until then
+        safe_callback("Refining loops...", 80)
+
+        best_webm_candidates = refine_candidates(
+            search_video_path, best_webm_candidates, step_size, search_start_frame, search_end_frame
+        )
+    finally:
+        if hash_cache is not None:
+            close_frame_hash_cache(hash_cache)
+
+    if frame_offset:
+        # Report the loops in frames of the source video
+        best_webm_candidates = [
+            CandidateLoop(
+                candidate.score,
+                candidate.start_frame_number + frame_offset,
+                candidate.end_frame_number + frame_offset,
+                candidate.frame_rate,
+            )
+            for candidate in best_webm_candidates
+        ]
+
+    lazy_formats = LAZY_FORMATS if LAZY_RENDERING and not stabilize else ()
+    eager_formats = tuple(f for f in ("webm", "gif", "mp4") if f not in lazy_formats)
+
+    # The video the loops get encoded from
+    loop_source_path = path_of_source_video
+    source_start_time = 0.0
+
+    if stabilize:
+        # The stabilized window is all-intra at LOOP_WIDTH already, just like a mezzanine
+        loop_source_path = stable_video_path
+        source_start_time = stable_start_time
+    elif MEZZANINE and ENCODE_MODE != "single" and len(eager_formats) > 1:
+        # A single encode decodes each loop only once anyway
+        safe_callback("Preparing loops...", 82)
+
+        for counter, candidate in enumerate(best_webm_candidates, 1):
+            candidate.source_path = os.path.join(frame_directory_path, MEZZANINE_NAME.format(counter))
+            candidate.source_start_time = make_mezzanine(
+                path_of_source_video,
+                candidate.source_path,
+                candidate.start_frame_number,
+                candidate.end_frame_number,
+                frame_rate,
+                sound_enabled,
+            )
+
+    # Add ffmpeg commands for each candidate
     best_webm_candidates = add_info_to_candidates(
         best_webm_candidates,
         webm_destination_folder,
-        path_of_source_video,
+        loop_source_path,
         frame_directory_path,
         sound_enabled,
+        eager_formats,
+        source_start_time,
     )
 
     # Create some number of loops after search has finished
     create_candidate_loops(best_webm_candidates, safe_callback)
 
+    # Lazily rendered loops are rendered from the source video, so it's kept out of the way for them
+    if lazy_formats and best_webm_candidates:
+        keep_render_source(
+            best_webm_candidates,
+            webm_destination_folder,
+            loop_source_path,
+            sound_enabled,
+            source_start_time,
+        )
+
+    intermediate_files = []
+
+    if loop_source_path != path_of_source_video:
+        intermediate_files.append(loop_source_path)
+
     # Delete video, and all frames folders
-    clean_up_folders(temp_frames_folder, frame_directory_path, path_of_source_video)
+    clean_up_folders(
+        temp_frames_folder,
+        frame_directory_path,
+        path_of_source_video,
+        intermediate_files=intermediate_files,
+    )
 
     results = get_video_info_tuple(best_webm_candidates, webm_destination_folder)
 
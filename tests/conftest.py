@@ -0,0 +1,5 @@
+import os
+import sys
+
+# loopifi.loops imports its `context` module as a top level one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "loopifi", "loops"))
@@ -0,0 +1,126 @@
+import os
+
+import pytest
+
+import loopifi
+from loopifi import loops
+
+
+class FakeJob(object):
+    def __init__(self, args):
+        self.args = args
+        self.is_finished = False
+        self.is_failed = False
+
+
+class FakeQueue(object):
+    """Stands in for the RQ queue, keeping what's queued instead of running it"""
+
+    def __init__(self):
+        self.jobs = {}
+
+    def fetch_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    def enqueue_call(self, func, args=None, kwargs=None, job_id=None, **options):
+        self.jobs[job_id] = FakeJob(args)
+
+        return self.jobs[job_id]
+
+
+@pytest.fixture
+def queue():
+    return FakeQueue()
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch, queue):
+    settings_path = tmp_path / "settings.cfg"
+    settings_path.write_text(
+        "SQLALCHEMY_DATABASE_URI = {!r}\nUPLOAD_FOLDER = {!r}\nRENDER_WAIT_SECONDS = 0\n".format(
+            "sqlite:///" + str(tmp_path / "loops.db"), str(tmp_path / "res")
+        )
+    )
+    monkeypatch.setenv("LOOPER_SETTINGS", str(settings_path))
+    monkeypatch.setattr(loops, "RENDER_SOURCE_FOLDER", str(tmp_path / "render_sources"))
+
+    app = loopifi.create_app()
+    monkeypatch.setattr(app.extensions["rq2"], "get_queue", lambda name=None: queue)
+
+    # Record 1 is done, record 2 is still being loopified
+    with app.app_context():
+        db = app.extensions["sqlalchemy"].db
+        db.create_all()
+
+        Record = db.Model._decl_class_registry["Record"]
+        db.session.add_all([Record(done=True), Record(done=False)])
+        db.session.commit()
+
+    return app
+
+
+# The loops folder of a record, with the render source of its single loop if `lazy`
+def make_loops_folder(app, record_id, lazy=True):
+    job_folder = os.path.join(app.config["UPLOAD_FOLDER"], str(record_id))
+    loops_folder = os.path.join(job_folder, "Loops")
+    os.makedirs(loops_folder)
+
+    with open(os.path.join(loops_folder, "1.webm"), "wb") as webm_file:
+        webm_file.write(b"not really a webm")
+
+    if lazy:
+        source_path = os.path.join(job_folder, "video.mp4")
+
+        with open(source_path, "wb") as source_file:
+            source_file.write(b"not really a video")
+
+        loops.keep_render_source([loops.CandidateLoop(100, 30, 90, 30.0)], loops_folder, source_path, True)
+
+    return loops_folder
+
+
+def test_render_redirects_to_loops_that_are_there(app, queue):
+    # Stabilized jobs & jobs from before lazy rendering have all their loops, and no render info
+    loops_folder = make_loops_folder(app, 1, lazy=False)
+
+    with open(os.path.join(loops_folder, "1.gif"), "wb") as gif_file:
+        gif_file.write(b"not really a gif")
+
+    response = app.test_client().get("/loops/1/render/1.gif")
+
+    assert response.status_code == 302
+    assert response.location.endswith("/res/1/Loops/1.gif")
+    assert queue.jobs == {}
+
+
+def test_render_queues_one_render_job_per_loop(app, queue):
+    make_loops_folder(app, 1)
+    client = app.test_client()
+
+    response = client.get("/loops/1/render/1.gif")
+
+    assert response.status_code == 302
+    assert response.location.endswith("/loops/1/render/1.gif?attempt=1")
+    assert list(queue.jobs) == ["render-1-1.gif"]
+    assert queue.jobs["render-1-1.gif"].args == (1, "1.gif")
+
+    # Waiting on the job that's already queued
+    response = client.get("/loops/1/render/1.gif?attempt=1")
+
+    assert response.location.endswith("/loops/1/render/1.gif?attempt=2")
+    assert list(queue.jobs) == ["render-1-1.gif"]
+
+    queue.jobs["render-1-1.gif"].is_failed = True
+
+    assert client.get("/loops/1/render/1.gif?attempt=2").status_code == 500
+
+
+def test_render_only_renders_loops_of_jobs_that_are_done(app, queue):
+    make_loops_folder(app, 1)
+    client = app.test_client()
+
+    assert client.get("/loops/1/render/2.gif").status_code == 404
+    assert client.get("/loops/1/render/1.mkv").status_code == 404
+    assert client.get("/loops/2/render/1.gif").status_code == 404
+    assert client.get("/loops/3/render/1.gif").status_code == 404
+    assert queue.jobs == {}
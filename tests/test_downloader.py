@@ -0,0 +1,85 @@
+import time
+
+import pytest
+
+from loopifi import downloader
+
+VIDEO_URL = "https://www.youtube.com/watch?v=G1IbRujko-A"
+CACHE_KEY = downloader.METADATA_CACHE_PREFIX + "G1IbRujko-A"
+
+
+# A signed download URL that expires `seconds` from now
+def make_signed_url(seconds, name="video"):
+    return f"https://example.googlevideo.com/{name}?expire={int(time.time() + seconds)}&sig=abc"
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    """Stands in for ffmpeg, answering with a 403 for every URL in `rejected`, and keeps the URLs downloaded from"""
+    downloads = {"urls": [], "rejected": set()}
+
+    def run_ffmpeg_download(real_url, path, start_seconds, end_seconds):
+        downloads["urls"].append(real_url)
+
+        if real_url in downloads["rejected"]:
+            return 1, "Server returned 403 Forbidden (access denied)"
+
+        return 0, ""
+
+    monkeypatch.setattr(downloader, "run_ffmpeg_download", run_ffmpeg_download)
+
+    return downloads
+
+
+@pytest.fixture
+def extracted_urls(monkeypatch):
+    """The URLs youtube-dl hands out, in order"""
+    extracted_urls = [make_signed_url(6 * 60 * 60, "first"), make_signed_url(6 * 60 * 60, "second")]
+    handed_out = iter(extracted_urls)
+
+    monkeypatch.setattr(downloader, "extract_download_url", lambda url: next(handed_out))
+
+    return extracted_urls
+
+
+def test_get_cache_ttl():
+    assert downloader.get_cache_ttl("https://example.googlevideo.com/video") == downloader.METADATA_CACHE_TTL
+    assert downloader.get_cache_ttl(make_signed_url(6 * 60 * 60)) == downloader.METADATA_CACHE_TTL
+
+    # Cached until the expiry margin before the URL expires
+    ttl = downloader.get_cache_ttl(make_signed_url(30 * 60))
+    expected_ttl = 30 * 60 - downloader.METADATA_CACHE_EXPIRY_MARGIN
+    assert expected_ttl - 5 <= ttl <= expected_ttl
+
+    assert downloader.get_cache_ttl(make_signed_url(60)) <= 0
+
+
+def test_download_url_is_cached(downloads, extracted_urls):
+    cache = downloader.LocalMetadataCache()
+
+    downloader.download_video(VIDEO_URL, "video.mp4", 0, 30, cache)
+    downloader.download_video(VIDEO_URL, "video.mp4", 0, 30, cache)
+
+    assert downloads["urls"] == [extracted_urls[0], extracted_urls[0]]
+    assert cache.get(CACHE_KEY) == extracted_urls[0]
+
+
+def test_rejected_download_url_is_refreshed(downloads, extracted_urls):
+    cache = downloader.LocalMetadataCache()
+    downloads["rejected"].add(extracted_urls[0])
+
+    downloader.download_video(VIDEO_URL, "video.mp4", 0, 30, cache)
+
+    assert downloads["urls"] == extracted_urls
+    assert cache.get(CACHE_KEY) == extracted_urls[1]
+
+
+def test_rejected_refreshed_download_url_is_not_cached(downloads, extracted_urls):
+    cache = downloader.LocalMetadataCache()
+    downloads["rejected"].update(extracted_urls)
+
+    with pytest.raises(downloader.InvalidUrlException):
+        downloader.download_video(VIDEO_URL, "video.mp4", 0, 30, cache)
+
+    assert downloads["urls"] == extracted_urls
+    assert cache.get(CACHE_KEY) is None
@@ -0,0 +1,593 @@
+import json
+import os
+import shutil
+from fractions import Fraction
+
+import imagehash
+import numpy as np
+import pytest
+from PIL import Image
+
+from loopifi import loops
+
+
+FRAME_RATE = 30.0
+STEP_SIZE = 5
+
+
+# Hashes of a video that repeats every `period` hashed frames, with a little noise so that no two frames are the same
+def make_hash_matrix(number_of_frames=160, period=9, noise=0.02, seed=0):
+    random = np.random.RandomState(seed)
+    hash_bits = loops.HASH_SIZE ** 2
+
+    scenes = random.randint(0, 2, (period, hash_bits)).astype(bool)
+    frames = scenes[np.arange(number_of_frames) % period] ^ (random.rand(number_of_frames, hash_bits) < noise)
+
+    return loops.pack_hash_bits(frames.reshape(number_of_frames, loops.HASH_SIZE, loops.HASH_SIZE))
+
+
+# Motion energy with a static stretch, and no motion for the first frame, like `compute_frame_hashes` gives
+def make_motion(number_of_frames=160, seed=0):
+    motion = np.random.RandomState(seed).uniform(0, 4, number_of_frames).astype(np.float32)
+    motion[40:60] = 0
+    motion[0] = np.nan
+
+    return motion
+
+
+def make_hash_db(hash_matrix, first_frame=0, motion=None):
+    return loops.FrameHashDatabase(hash_matrix, first_frame, STEP_SIZE, motion=motion)
+
+
+def hamming_distance(first_hash, second_hash):
+    return int(np.unpackbits((first_hash ^ second_hash).view(np.uint8)).sum())
+
+
+def baseline_search(hash_db):
+    """The search `find_best_matches` replaced, comparing one start frame & candidate at a time"""
+    frame_numbers = list(hash_db.frame_numbers)
+    loop_candidates = []
+
+    for index, start_frame in enumerate(frame_numbers):
+        best_candidate = None
+        best_score = loops.MAX_HASH_DIFFERENCE
+        candidate_counter = 0
+
+        for candidate_frame in frame_numbers[index + 1 :]:
+            candidate_counter += hash_db.step_size
+
+            if candidate_counter < loops.MINIMUM_LOOP_FRAMES:
+                continue
+            elif candidate_counter > loops.MAXIMUM_LOOP_FRAMES:
+                break
+
+            score = hamming_distance(hash_db.get(start_frame), hash_db.get(candidate_frame))
+
+            if score < loops.SIMILARITY_THRESHOLD and score < best_score:
+                middle_frame = (start_frame + candidate_frame) // 2
+                middle_score = hamming_distance(hash_db.get(start_frame), hash_db.get(middle_frame))
+
+                if (middle_score / loops.MAX_HASH_DIFFERENCE) * 100 < loops.MIN_MID_FRAME_SIMILARITY:
+                    continue
+
+                best_score = score
+                best_candidate = (score, start_frame, candidate_frame)
+
+        if best_candidate is not None:
+            loop_candidates.append(best_candidate)
+
+    return sorted(loop_candidates, key=lambda candidate: candidate[0])
+
+
+def as_tuples(loop_candidates):
+    return [
+        (candidate.score, candidate.start_frame_number, candidate.end_frame_number) for candidate in loop_candidates
+    ]
+
+
+@pytest.fixture
+def plain_search(monkeypatch):
+    # Only what the baseline search did: no cascade, scene cuts or static start frames
+    monkeypatch.setattr(loops, "HASH_CASCADE_LEVELS", ())
+    monkeypatch.setattr(loops, "SCENE_CUTS", False)
+    monkeypatch.setattr(loops, "MOTION_PREFILTER", False)
+
+
+def test_search_for_loops_matches_baseline_search(plain_search):
+    hash_db = make_hash_db(make_hash_matrix(), first_frame=100)
+
+    loop_candidates = loops.search_for_loops(hash_db, FRAME_RATE, lambda status, progress: None, workers=1)
+
+    assert loop_candidates
+    assert as_tuples(loop_candidates) == baseline_search(hash_db)
+
+
+def test_find_best_matches_matches_baseline_search(plain_search):
+    hash_db = make_hash_db(make_hash_matrix(period=13, noise=0.05, seed=1))
+
+    best_offsets, best_scores = loops.find_best_matches(hash_db.hashes, hash_db.frame_numbers, STEP_SIZE)
+    loop_candidates = loops.collect_candidates(best_offsets, best_scores, hash_db.frame_numbers, FRAME_RATE)
+    loop_candidates.sort(key=lambda candidate: candidate.score)
+
+    assert as_tuples(loop_candidates) == baseline_search(hash_db)
+
+
+def test_phash_batch_matches_imagehash():
+    random = np.random.RandomState(0)
+    side = loops.HASH_INPUT_SIZE
+
+    # Smooth frames like real ones, and plain noise
+    smooth_frames = [
+        np.array(Image.fromarray(random.randint(0, 256, (8, 8), dtype=np.uint8)).resize((side, side), Image.BILINEAR))
+        for _ in range(3)
+    ]
+    noise_frames = list(random.randint(0, 256, (3, side, side), dtype=np.uint8))
+    gray_frames = np.stack(smooth_frames + noise_frames)
+
+    expected_hashes = [
+        imagehash.phash(Image.fromarray(frame), hash_size=loops.HASH_SIZE).hash for frame in gray_frames
+    ]
+
+    np.testing.assert_array_equal(loops.phash_batch(gray_frames), expected_hashes)
+
+
+def test_pivot_backend_matches_band_backend():
+    hash_matrix = make_hash_matrix(number_of_frames=200, period=11, noise=0.03, seed=2)
+    frame_numbers = np.arange(len(hash_matrix), dtype=np.int64) * STEP_SIZE
+    motion = make_motion(len(hash_matrix), seed=2)
+
+    band_matches = loops.find_best_matches(hash_matrix, frame_numbers, STEP_SIZE, backend="band", motion=motion)
+    pivot_matches = loops.find_best_matches(hash_matrix, frame_numbers, STEP_SIZE, backend="pivot", motion=motion)
+
+    assert (band_matches[0] >= 0).any()
+    np.testing.assert_array_equal(pivot_matches[0], band_matches[0])
+    np.testing.assert_array_equal(pivot_matches[1], band_matches[1])
+
+
+
+def test_parallel_search_matches_serial_search():
+    hash_matrix = make_hash_matrix(number_of_frames=200, seed=3)
+    frame_numbers = 50 + np.arange(len(hash_matrix), dtype=np.int64) * STEP_SIZE
+    motion = make_motion(len(hash_matrix), seed=3)
+
+    serial_matches = loops.find_best_matches(hash_matrix, frame_numbers, STEP_SIZE, motion=motion)
+    parallel_matches = loops.find_best_matches_parallel(
+        hash_matrix, frame_numbers, STEP_SIZE, workers=2, chunk_size=32, motion=motion
+    )
+
+    np.testing.assert_array_equal(parallel_matches[0], serial_matches[0])
+    np.testing.assert_array_equal(parallel_matches[1], serial_matches[1])
+
+
+def test_incremental_search_matches_serial_search():
+    hash_matrix = make_hash_matrix(number_of_frames=300, period=7, seed=4)
+    motion = make_motion(len(hash_matrix), seed=4)
+    hash_db = make_hash_db(hash_matrix, first_frame=0, motion=motion)
+
+    candidate_selector = loops.CandidateSelector()
+
+    for candidate in loops.search_for_loops(hash_db, FRAME_RATE, lambda status, progress: None, workers=1):
+        candidate_selector.push(candidate)
+
+    loop_search = loops.IncrementalLoopSearch(FRAME_RATE, chunk_size=16, step_size=STEP_SIZE)
+
+    for batch_start in range(0, len(hash_matrix), 23):
+        batch = slice(batch_start, batch_start + 23)
+        loop_search.add(hash_db.frame_numbers[batch], hash_matrix[batch], motion[batch])
+
+    assert as_tuples(loop_search.finish()) == as_tuples(candidate_selector.select())
+
+
+def test_candidate_selector_skips_overlapping_loops():
+    candidate_selector = loops.CandidateSelector(count=3, pool_size=5)
+
+    for score, start_frame, end_frame in [
+        (900, 300, 400),
+        (100, 0, 100),
+        (200, 5, 100),  # The best loop shifted by a few frames
+        (300, 50, 150),  # Overlaps the best loop by a third
+        (150, 1000, 1050),
+        (800, 2000, 2100),
+        (950, 3000, 3100),  # Doesn't fit in the pool
+    ]:
+        candidate_selector.push(loops.CandidateLoop(score, start_frame, end_frame, FRAME_RATE))
+
+    assert as_tuples(candidate_selector.select()) == [(100, 0, 100), (150, 1000, 1050), (300, 50, 150)]
+
+    candidate_selector = loops.CandidateSelector(count=5, pool_size=5)
+
+    for score, start_frame, end_frame in [(100, 0, 100), (200, 5, 100), (950, 3000, 3100)]:
+        candidate_selector.push(loops.CandidateLoop(score, start_frame, end_frame, FRAME_RATE))
+
+    assert as_tuples(candidate_selector.select()) == [(100, 0, 100), (950, 3000, 3100)]
+
+
+@pytest.fixture
+def frame_hashes(monkeypatch):
+    # A video whose every frame is hashed, and that repeats every 37 frames
+    hash_matrix = make_hash_matrix(number_of_frames=200, period=37, seed=5)
+
+    def hash_frame_range(video_path, frame_rate, start_frame, end_frame):
+        return np.arange(start_frame, end_frame, dtype=np.int64), hash_matrix[start_frame:end_frame]
+
+    monkeypatch.setattr(loops, "hash_frame_range", hash_frame_range)
+
+    return hash_matrix
+
+
+def test_refine_candidate_moves_to_the_best_frames(frame_hashes):
+    coarse_score = hamming_distance(frame_hashes[10], frame_hashes[45])
+    candidate = loops.CandidateLoop(coarse_score, 10, 45, FRAME_RATE)
+
+    refined = loops.refine_candidate("video.mp4", candidate, STEP_SIZE, 0, 200)
+
+    assert refined.end_frame_number - refined.start_frame_number == 37
+    assert abs(refined.start_frame_number - 10) < STEP_SIZE and abs(refined.end_frame_number - 45) < STEP_SIZE
+    assert refined.score == hamming_distance(
+        frame_hashes[refined.start_frame_number], frame_hashes[refined.end_frame_number]
+    )
+    assert refined.score < coarse_score
+
+    # Nothing within a step scores strictly better than an exact loop, or there is nothing to refine
+    assert loops.refine_candidate("video.mp4", refined, STEP_SIZE, 0, 200) is refined
+    assert loops.refine_candidate("video.mp4", candidate, 1, 0, 200) is candidate
+
+
+def test_refine_candidates_sorts_loops_best_first(monkeypatch):
+    refined_scores = {10: 100, 50: 300, 90: 50}
+
+    def refine_candidate(video_path, candidate, step_size, start_frame, end_frame):
+        return loops.CandidateLoop(
+            refined_scores[candidate.start_frame_number],
+            candidate.start_frame_number,
+            candidate.end_frame_number,
+            candidate.frame_rate,
+        )
+
+    monkeypatch.setattr(loops, "refine_candidate", refine_candidate)
+
+    candidates = [
+        loops.CandidateLoop(score, start_frame, start_frame + 30, FRAME_RATE)
+        for score, start_frame in [(100, 10), (200, 90), (300, 50)]
+    ]
+
+    refined = loops.refine_candidates("video.mp4", candidates, STEP_SIZE, 0, 200)
+
+    assert as_tuples(refined) == [(50, 90, 120), (100, 10, 40), (300, 50, 80)]
+
+
+def test_frame_hash_cache_round_trip(tmp_path):
+    video_path = tmp_path / "video.mp4"
+    video_path.write_bytes(b"not really a video")
+    cache_folder = str(tmp_path / "cache")
+
+    hash_matrix = make_hash_matrix(number_of_frames=3)
+    frame_numbers = np.array([10, 15, 20], dtype=np.int64)
+    motion = np.array([np.nan, 1.5, 2.5], dtype=np.float32)
+
+    hash_cache = loops.FrameHashCache(str(video_path), STEP_SIZE, 100, cache_folder)
+
+    assert hash_cache.runs(0, 100) == [(0, 100, False)]
+
+    hash_cache.store(frame_numbers, hash_matrix, motion)
+    hash_cache.close()
+
+    # Reopening the entry finds what was stored
+    hash_cache = loops.FrameHashCache(str(video_path), STEP_SIZE, 100, cache_folder)
+
+    assert hash_cache.runs(3, 98) == [(5, 10, False), (10, 25, True), (25, 98, False)]
+
+    (read_frame_numbers, read_hashes, read_motion), = hash_cache.read(10, 25)
+
+    np.testing.assert_array_equal(read_frame_numbers, frame_numbers)
+    np.testing.assert_array_equal(read_hashes, hash_matrix)
+    np.testing.assert_array_equal(read_motion, motion)
+
+    hash_cache.close()
+
+    # Other hashing parameters or variants of the video get their own entry
+    other_cache = loops.FrameHashCache(str(video_path), STEP_SIZE, 100, cache_folder, variant="proxy")
+
+    assert other_cache.runs(10, 25) == [(10, 25, False)]
+
+    other_cache.close()
+
+
+def test_hash_cache_entries_in_use_are_not_evicted(tmp_path):
+    video_path = tmp_path / "video.mp4"
+    video_path.write_bytes(b"not really a video")
+    cache_folder = str(tmp_path / "cache")
+
+    hash_cache = loops.FrameHashCache(str(video_path), STEP_SIZE, 100, cache_folder)
+
+    loops.evict_hash_cache(cache_folder, max_bytes=0)
+    assert os.path.exists(hash_cache.entry_path)
+
+    hash_cache.close()
+
+    loops.evict_hash_cache(cache_folder, max_bytes=0)
+    assert not os.path.exists(hash_cache.entry_path)
+
+
+def test_lock_cache_entry_recreates_an_entry_evicted_before_it_was_locked(tmp_path, monkeypatch):
+    entry_path = str(tmp_path / "entry")
+    makedirs = os.makedirs
+    created = []
+
+    # The entry gets evicted right after it's first created
+    def makedirs_then_evict(path, exist_ok=False):
+        makedirs(path, exist_ok=exist_ok)
+
+        if not created:
+            shutil.rmtree(path)
+
+        created.append(path)
+
+    monkeypatch.setattr(loops.os, "makedirs", makedirs_then_evict)
+
+    lock_file = loops.lock_cache_entry(entry_path)
+    lock_file.close()
+
+    assert created == [entry_path, entry_path]
+    assert os.path.exists(os.path.join(entry_path, loops.CACHE_ENTRY_LOCK_NAME))
+
+
+def test_incremental_search_on_workers_matches_serial_search():
+    hash_matrix = make_hash_matrix(number_of_frames=300, period=7, seed=6)
+    motion = make_motion(len(hash_matrix), seed=6)
+    loop_searches = [
+        loops.IncrementalLoopSearch(FRAME_RATE, chunk_size=16, step_size=STEP_SIZE, workers=workers)
+        for workers in (1, 2)
+    ]
+    frame_numbers = np.arange(len(hash_matrix), dtype=np.int64) * STEP_SIZE
+
+    for loop_search in loop_searches:
+        for batch_start in range(0, len(hash_matrix), 23):
+            batch = slice(batch_start, batch_start + 23)
+            loop_search.add(frame_numbers[batch], hash_matrix[batch], motion[batch])
+
+    serial_search, parallel_search = loop_searches
+
+    assert as_tuples(parallel_search.finish()) == as_tuples(serial_search.finish())
+    assert parallel_search.search_pool is None
+
+
+# Hashes of shots of `shot_length` hashed frames, shot n showing scene `scenes[n]`. Each scene drifts away from how it
+# starts and back, so its first & last frames loop
+def make_shots(scenes, shot_length=30, drift=0.02, seed=7):
+    random = np.random.RandomState(seed)
+    hash_bits = loops.HASH_SIZE ** 2
+
+    starts = random.randint(0, 2, (max(scenes) + 1, hash_bits)).astype(bool)
+    flips = random.rand(len(starts), shot_length // 2, hash_bits) < drift
+    drifting = starts[:, np.newaxis] ^ np.logical_xor.accumulate(flips, axis=1)
+    scene_frames = np.concatenate([drifting, drifting[:, ::-1]], axis=1)
+
+    frames = np.concatenate([scene_frames[scene] for scene in scenes])
+
+    return loops.pack_hash_bits(frames.reshape(len(frames), loops.HASH_SIZE, loops.HASH_SIZE))
+
+
+def test_get_shot_ids_splits_at_cuts():
+    hash_matrix = make_shots([0, 1, 2])
+
+    np.testing.assert_array_equal(loops.get_shot_ids(hash_matrix), np.repeat([0, 1, 2], 30))
+
+    # Nothing but noise is one shot
+    np.testing.assert_array_equal(loops.get_shot_ids(make_hash_matrix(period=1)), np.zeros(160))
+
+
+def test_loops_do_not_span_cuts(monkeypatch):
+    # The first & last shot are the same scene, so frames of the first one match across the shot in between
+    hash_matrix = make_shots([0, 1, 0])
+    frame_numbers = np.arange(len(hash_matrix), dtype=np.int64) * STEP_SIZE
+    shot_ids = loops.get_shot_ids(hash_matrix)
+
+    monkeypatch.setattr(loops, "SCENE_CUTS", False)
+    best_offsets, _ = loops.find_best_matches(hash_matrix, frame_numbers, STEP_SIZE)
+    assert (best_offsets[:30] >= 30).any()
+
+    monkeypatch.setattr(loops, "SCENE_CUTS", True)
+    best_offsets, _ = loops.find_best_matches(hash_matrix, frame_numbers, STEP_SIZE)
+    matched_starts = np.flatnonzero(best_offsets >= 0)
+
+    assert len(matched_starts)
+    np.testing.assert_array_equal(
+        shot_ids[matched_starts], shot_ids[matched_starts + best_offsets[matched_starts]]
+    )
+
+
+def test_get_static_starts_finds_starts_of_still_runs():
+    # With a step of 5 frames, a run of 30 static frames is 6 hashed frames
+    motion = np.array([np.nan, 3, 3] + [0.5] * 10 + [3] * 5, dtype=np.float32)
+
+    np.testing.assert_array_equal(
+        np.flatnonzero(loops.get_static_starts(motion, STEP_SIZE)), [2, 3, 4, 5, 6]
+    )
+
+    # Unknown motion is never static, and neither is a run cut short by the end of the video
+    assert not loops.get_static_starts(np.full(10, np.nan, dtype=np.float32), STEP_SIZE).any()
+    assert not loops.get_static_starts(np.zeros(6, dtype=np.float32), STEP_SIZE).any()
+
+
+def test_static_starts_are_not_searched():
+    hash_matrix = make_hash_matrix(seed=8)
+    frame_numbers = np.arange(len(hash_matrix), dtype=np.int64) * STEP_SIZE
+    motion = make_motion(len(hash_matrix), seed=8)
+    static_starts = loops.get_static_starts(motion, STEP_SIZE)
+
+    best_offsets, _ = loops.find_best_matches(hash_matrix, frame_numbers, STEP_SIZE, motion=motion)
+    all_offsets, _ = loops.find_best_matches(hash_matrix, frame_numbers, STEP_SIZE)
+
+    assert static_starts.any()
+    assert (best_offsets[static_starts] == -1).all()
+    assert (all_offsets[static_starts] >= 0).all()
+    np.testing.assert_array_equal(best_offsets[~static_starts], all_offsets[~static_starts])
+
+
+def test_cached_frame_hashes_counts_frames_of_the_source(tmp_path, monkeypatch):
+    video_path = tmp_path / "video.mp4"
+    video_path.write_bytes(b"not really a video")
+    hash_matrix = make_hash_matrix(number_of_frames=40)
+    computed_intervals = []
+
+    # Windows are named after the source frame they start at. Frame n of a window is frame start + n of the source
+    def compute_frame_hashes(window_start, frame_rate, start_frame, end_frame, step_size):
+        computed_intervals.append((start_frame, end_frame))
+        frame_numbers = np.arange(-(-start_frame // step_size) * step_size, end_frame, step_size, dtype=np.int64)
+        rows = (frame_numbers + window_start) // step_size
+
+        yield frame_numbers, hash_matrix[rows], rows.astype(np.float32)
+
+    monkeypatch.setattr(loops, "compute_frame_hashes", compute_frame_hashes)
+
+    hash_cache = loops.FrameHashCache(str(video_path), STEP_SIZE, 200, str(tmp_path / "cache"))
+
+    first_window = list(loops.cached_frame_hashes(hash_cache, 100, FRAME_RATE, 0, 50, STEP_SIZE, 100))
+    second_window = list(loops.cached_frame_hashes(hash_cache, 75, FRAME_RATE, 0, 75, STEP_SIZE, 75))
+
+    hash_cache.close()
+
+    # Only frames 75 to 100 of the source weren't hashed by the first window
+    assert computed_intervals == [(0, 50), (0, 25)]
+
+    (frame_numbers, hashes, _), = first_window
+    np.testing.assert_array_equal(frame_numbers, np.arange(0, 50, STEP_SIZE))
+    np.testing.assert_array_equal(hashes, hash_matrix[20:30])
+
+    frame_numbers = np.concatenate([batch[0] for batch in second_window])
+    hashes = np.concatenate([batch[1] for batch in second_window])
+    np.testing.assert_array_equal(frame_numbers, np.arange(0, 75, STEP_SIZE))
+    np.testing.assert_array_equal(hashes, hash_matrix[15:30])
+
+    with pytest.raises(ValueError):
+        list(loops.cached_frame_hashes(hash_cache, 3, FRAME_RATE, 0, 50, STEP_SIZE, 3))
+
+
+@pytest.fixture
+def render_sources(tmp_path, monkeypatch):
+    render_sources_folder = str(tmp_path / "render_sources")
+    monkeypatch.setattr(loops, "RENDER_SOURCE_FOLDER", render_sources_folder)
+
+    return render_sources_folder
+
+
+# The folder of a job that's done, with its source video & the loops folder
+def make_job_folder(tmp_path, job_id):
+    job_folder = tmp_path / "res" / str(job_id)
+    (job_folder / "Loops").mkdir(parents=True)
+    (job_folder / "video.mp4").write_bytes(b"not really a video")
+
+    return job_folder
+
+
+def test_keep_render_source_moves_the_source_out_of_the_job_folder(tmp_path, render_sources):
+    job_folder = make_job_folder(tmp_path, 7)
+    loops_folder = str(job_folder / "Loops")
+    candidates = [loops.CandidateLoop(100, 30, 90, FRAME_RATE), loops.CandidateLoop(200, 300, 345, FRAME_RATE)]
+
+    render_source_path = loops.keep_render_source(candidates, loops_folder, str(job_folder / "video.mp4"), True)
+
+    assert render_source_path == os.path.join(render_sources, "7", "video.mp4")
+    assert os.path.exists(render_source_path)
+    assert sorted(os.listdir(str(job_folder))) == ["Loops"]
+    assert os.listdir(loops_folder) == []
+
+    render_info, counter, file_format = loops.check_lazy_loop(loops_folder, "2.gif")
+
+    assert (counter, file_format) == ("2", "gif")
+    assert render_info["loops"]["2"] == [300, 345, FRAME_RATE]
+    assert render_info["loops_folder"] == os.path.abspath(loops_folder)
+
+    with pytest.raises(FileNotFoundError):
+        loops.check_lazy_loop(loops_folder, "3.gif")
+
+    with pytest.raises(ValueError):
+        loops.check_lazy_loop(loops_folder, "1.webm")
+
+
+def test_expire_render_sources_renders_what_is_left_first(tmp_path, render_sources, monkeypatch):
+    rendered = []
+
+    def render_lazy_loop(webm_destination_folder, file_name):
+        # Whatever was rendered before the render source expired is all there is
+        assert os.path.exists(os.path.join(loops.get_render_source_folder(webm_destination_folder), "video.mp4"))
+        rendered.append((os.path.basename(os.path.dirname(webm_destination_folder)), file_name))
+
+    monkeypatch.setattr(loops, "render_lazy_loop", render_lazy_loop)
+
+    for job_id, age in ((1, 2 * 24 * 60 * 60), (2, 60)):
+        job_folder = make_job_folder(tmp_path, job_id)
+        candidates = [loops.CandidateLoop(100, 30, 90, FRAME_RATE)]
+        loops.keep_render_source(candidates, str(job_folder / "Loops"), str(job_folder / "video.mp4"), True)
+
+        done_time = os.path.getmtime(os.path.join(render_sources, str(job_id), loops.RENDER_INFO_FILE)) - age
+        os.utime(os.path.join(render_sources, str(job_id), loops.RENDER_INFO_FILE), (done_time, done_time))
+
+    loops.expire_render_sources(render_sources, ttl=24 * 60 * 60)
+
+    assert rendered == [("1", "1.gif"), ("1", "1.mp4")]
+    assert os.listdir(render_sources) == ["2"]
+
+    # Render sources that don't fit go too, oldest first
+    loops.expire_render_sources(render_sources, ttl=24 * 60 * 60, max_bytes=0)
+
+    assert rendered[2:] == [("2", "1.gif"), ("2", "1.mp4")]
+    assert os.listdir(render_sources) == []
+
+
+def test_render_lazy_loop_does_not_need_the_render_source_of_rendered_loops(tmp_path, render_sources):
+    loops_folder = make_job_folder(tmp_path, 3) / "Loops"
+    (loops_folder / "1.gif").write_bytes(b"not really a gif")
+
+    assert loops.render_lazy_loop(str(loops_folder), "1.gif") == str(loops_folder / "1.gif")
+
+
+def test_parse_frame_rate():
+    assert loops.parse_frame_rate("30000/1001") == Fraction(30000, 1001)
+    assert loops.parse_frame_rate("25/1") == 25
+    assert loops.parse_frame_rate("0/0") is None
+    assert loops.parse_frame_rate("") is None
+    assert loops.parse_frame_rate(None) is None
+
+
+@pytest.mark.parametrize(
+    "r_frame_rate, avg_frame_rate, frame_rate, variable_frame_rate",
+    [
+        ("30000/1001", "30000/1001", Fraction(30000, 1001), False),
+        # Timestamps on a 1/90000 s grid, with about 24 frames per second
+        ("90000/1", "24/1", 24, True),
+        ("25/1", "0/0", 25, False),
+        ("0/0", "24/1", 24, False),
+    ],
+)
+def test_probe_counts_frames_at_the_average_frame_rate_of_vfr_videos(
+    tmp_path, monkeypatch, r_frame_rate, avg_frame_rate, frame_rate, variable_frame_rate
+):
+    video_path = tmp_path / "video.mp4"
+    video_path.write_bytes(b"not really a video")
+
+    def check_output(command, encoding=None):
+        return json.dumps(
+            {
+                "format": {"duration": "2.0"},
+                "streams": [
+                    {
+                        "codec_name": "h264",
+                        "width": 640,
+                        "height": 360,
+                        "r_frame_rate": r_frame_rate,
+                        "avg_frame_rate": avg_frame_rate,
+                    }
+                ],
+                "packets": [{"pts_time": str(index / 24)} for index in range(48)],
+            }
+        )
+
+    monkeypatch.setattr(loops.subprocess, "check_output", check_output)
+
+    media_info = loops.probe(str(video_path))
+
+    assert media_info.frame_rate == frame_rate
+    assert media_info.variable_frame_rate == variable_frame_rate
+    assert (media_info.duration, media_info.frame_count, media_info.width) == (2.0, 48, 640)